@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+import sys
+import connections
+import argparse
+import getpass
+from migrator import Logger, NSXT, readPlan, writePlan, executePlan, recordPlanResults, reUpdateMigrationLog, updateCatalog, RealizationWaiter, ConcurrencyController, readJson, updateStateResults
+from statedb import StateDb
+from catalog import Catalog
+
+def parseParameters():
+    parser=argparse.ArgumentParser()
+    parser.add_argument("--nsx", required=True,
+                        help="IP or FQDN of the destination NSX Manager")
+    parser.add_argument("--nsxUser", required=False,
+                        default="admin",
+                        help="User name to connect to destination NSX Manger")
+    parser.add_argument("--nsxPassword", required=False,
+                        help="Password for nsxUser")
+    parser.add_argument("--plan", required=True,
+                        help="The execution plan file produced by migrator.py --planOut")
+    parser.add_argument("--results", required=True,
+                        help="File to store the executed plan with the result of each API call")
+    parser.add_argument("--migrationData", required=False,
+                        help="The migration data JSON file produced with the plan, updated with submission results")
+    parser.add_argument("--concurrency", required=False, type=int, default=1,
+                        help="Number of API calls of a batch to submit concurrently, default: 1")
+    parser.add_argument("--maxConcurrency", required=False, type=int, default=0,
+                        help="Adapt the number of API calls in flight between 1 and this maximum, starting at --concurrency, based on destination latency and throttling, default: 0 for fixed --concurrency")
+    parser.add_argument("--batchSize", required=False, type=int,
+                        help="Maximum number of API calls per batch, default is the batch size of the plan")
+    parser.add_argument("--realizationTimeout", required=False, type=int, default=600,
+                        help="Seconds to wait for objects to be realized on destination before submitting objects that use them, 0 to not wait, default: 600")
+    parser.add_argument("--stateDb", required=False,
+                        help="State store written by migrator.py --stateDb to update with the submission results")
+    parser.add_argument("--catalog", required=False,
+                        help="Directory of the shared service and context profile catalog to add created objects to, requires --migrationData")
+    parser.add_argument("--connectTimeout", required=False, type=float, default=10,
+                        help="Seconds to wait for a connection to destination NSX, default: 10")
+    parser.add_argument("--readTimeout", required=False, type=float, default=300,
+                        help="Seconds to wait for destination NSX to answer a request, default: 300")
+    parser.add_argument("--nsxRate", required=False, type=float, default=0,
+                        help="Maximum requests per second to destination NSX, default: 0 for no limit")
+    parser.add_argument("--nsxConcurrency", required=False, type=int, default=0,
+                        help="Maximum requests in flight to destination NSX, default: 0 for no limit")
+    parser.add_argument("--logfile", required=False,
+                        default="applyplan-log.txt",
+                        help="Filename to store logs")
+
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = parseParameters()
+    site="default"
+    enforcementPoint="default"
+    domain="default"
+
+    logger = Logger(file=args.logfile, verbose=False)
+
+    logger.log("Reading execution plan %s" %args.plan, verbose=True)
+    plan = readPlan(args.plan)
+    if plan['nsx'] != args.nsx:
+        logger.log("WARN - plan was compiled for destination %s, applying to %s"
+                   %(plan['nsx'], args.nsx), verbose=True)
+
+    migrationData = None
+    if args.migrationData:
+        migrationData = readJson(args.migrationData)
+
+    if not args.nsxPassword:
+        nsxPassword = getpass.getpass("Enter the password for %s and user %s"
+                                     %(args.nsx, args.nsxUser))
+    else:
+        nsxPassword=args.nsxPassword
+
+    nsx = connections.NsxConnect(server=args.nsx, logger=logger,
+                                 user=args.nsxUser,
+                                 password=nsxPassword,
+                                 cookie=None, cert=None,
+                                 global_infra=False, global_gm=False,
+                                 site=site,
+                                 enforcement=enforcementPoint,
+                                 domain=domain,
+                                 timeout=(args.connectTimeout, args.readTimeout),
+                                 limiter=connections.RateLimiter(rate=args.nsxRate,
+                                                                 concurrency=args.nsxConcurrency))
+
+    NSX = NSXT(mp=nsx, logger=logger, site=site, enforcementPoint=enforcementPoint)
+    logger.log("Connected to %s with user %s" % (args.nsx, args.nsxUser), verbose=True)
+
+    controller = None
+    if args.maxConcurrency > args.concurrency:
+        controller = ConcurrencyController(args.concurrency, args.maxConcurrency,
+                                           throttled=lambda: nsx.throttled)
+
+    stateDb = None
+    if args.stateDb:
+        stateDb = StateDb(args.stateDb, logger)
+
+    def levelDone():
+        if controller:
+            plan['concurrency'] = controller.timeline
+        writePlan(plan, args.results)
+        if migrationData:
+            recordPlanResults(migrationData, plan)
+            if controller:
+                migrationData['concurrency'] = controller.timeline
+            reUpdateMigrationLog(migrationData, args.migrationData)
+        if stateDb:
+            updateStateResults(stateDb, plan)
+
+    waiter = None
+    if args.realizationTimeout:
+        waiter = RealizationWaiter(NSX, logger, timeout=args.realizationTimeout)
+    completed = executePlan(NSX, plan, logger, args, concurrency=args.concurrency,
+                            batchSize=args.batchSize, levelDone=levelDone, waiter=waiter,
+                            controller=controller)
+    if args.catalog and migrationData:
+        updateCatalog(Catalog(directory=args.catalog, nsx=plan['nsx'], logger=logger),
+                      migrationData, plan['prefix'])
+    if not completed:
+        logger.log("ERROR - plan %s did not complete, see %s for results"
+                   %(args.plan, args.results), verbose=True)
+        sys.exit()
+    logger.log("Plan %s completed" %args.plan, verbose=True)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+import os
+import json
+import tempfile
+import datetime
+
+class Catalog(object):
+    '''
+    Persistent content addressed catalog of services and context profiles
+    on a destination NSX.  Each entry maps the fingerprint of an object's
+    configuration to the path of the object on the destination, and is
+    stored in its own file:
+        <directory>/<nsx>/<kind>/<fingerprint>.json
+    Entries are written atomically, so the catalog can be shared by
+    migrator.py runs for several sites at the same time.
+    '''
+    def __init__(self, directory, nsx, logger):
+        self.directory = os.path.join(directory, nsx)
+        self.logger = logger
+
+    def __entryFile(self, kind, fingerprint):
+        return os.path.join(self.directory, kind, "%s.json" % fingerprint)
+
+    def lookup(self, kind, fingerprint):
+        '''
+        Return the catalog entry for fingerprint, None if not found
+        '''
+        try:
+            with open(self.__entryFile(kind, fingerprint), "r") as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            self.logger.log("WARN - ignoring corrupt catalog entry %s"
+                            % self.__entryFile(kind, fingerprint))
+            return None
+
+    def add(self, kind, fingerprint, path, prefix=None, oldPath=None):
+        '''
+        Record that the object with fingerprint is at path on the destination.
+        prefix is the migration prefix of the site that created the object,
+        None if the object was already on the destination
+        '''
+        entry = {}
+        entry['fingerprint'] = fingerprint
+        entry['path'] = path
+        entry['prefix'] = prefix
+        entry['oldPath'] = oldPath
+        entry['timestamp'] = str(datetime.datetime.utcnow())
+        fname = self.__entryFile(kind, fingerprint)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname), suffix=".tmp")
+        with os.fdopen(fd, "w") as fp:
+            json.dump(entry, fp)
+        os.replace(tmp, fname)
+        return entry
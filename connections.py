@@ -5,16 +5,138 @@ from requests.structures import CaseInsensitiveDict
 import base64
 import json
 import copy
+import time
+import threading
+import collections
+import concurrent.futures
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+class JsonCodec(object):
+    '''
+    Standard library JSON codec.  encode returns bytes, decode takes bytes
+    or str
+    '''
+    name = "json"
+    def encode(self, data):
+        return json.dumps(data, separators=(',', ':')).encode()
+
+    def decode(self, raw):
+        return json.loads(raw)
+
+class OrjsonCodec(JsonCodec):
+    '''
+    orjson codec, falls back to the standard library for data orjson
+    can't encode, e.g. non string keys
+    '''
+    name = "orjson"
+    def encode(self, data):
+        try:
+            return orjson.dumps(data)
+        except TypeError:
+            return JsonCodec.encode(self, data)
+
+    def decode(self, raw):
+        return orjson.loads(raw)
+
+def defaultCodec():
+    '''
+    The fastest JSON codec available
+    '''
+    if orjson:
+        return OrjsonCodec()
+    return JsonCodec()
+
+class DeadlineExceeded(Exception):
+    '''
+    Raised for a request made after the deadline set with
+    NsxConnect.setDeadline()
+    '''
+    pass
+
+class RateLimiter(object):
+    '''
+    Limits the requests to a manager with a token bucket of rate requests
+    per second refilled up to burst tokens, and with a semaphore of
+    concurrency requests in flight.  rate or concurrency of 0 or None is
+    unlimited.  The limiter is thread safe; create it with the
+    multiprocessing module (or a multiprocessing context) as ctx to share
+    it with worker processes, e.g. as a ProcessPoolExecutor initarg.
+    Use it as a context manager around each request.
+    '''
+    def __init__(self, rate=None, burst=None, concurrency=None, ctx=None):
+        self.rate = float(rate) if rate else None
+        self.burst = float(burst) if burst else max(1.0, self.rate or 1.0)
+        if ctx:
+            self.lock = ctx.Lock()
+            self.semaphore = ctx.BoundedSemaphore(concurrency) if concurrency else None
+            # tokens, time of last refill, no requests until
+            self.state = ctx.Array('d', [self.burst, time.monotonic(), 0.0], lock=False)
+        else:
+            self.lock = threading.Lock()
+            self.semaphore = threading.BoundedSemaphore(concurrency) if concurrency else None
+            self.state = [self.burst, time.monotonic(), 0.0]
+
+    def __take(self):
+        '''
+        Take a token, returns 0 or the seconds to wait before trying again
+        '''
+        with self.lock:
+            now = time.monotonic()
+            if now < self.state[2]:
+                return self.state[2] - now
+            if not self.rate:
+                return 0
+            tokens = min(self.burst, self.state[0] + (now - self.state[1]) * self.rate)
+            self.state[1] = now
+            if tokens >= 1:
+                self.state[0] = tokens - 1
+                return 0
+            self.state[0] = tokens
+            return (1 - tokens) / self.rate
+
+    def acquire(self):
+        if self.semaphore:
+            self.semaphore.acquire()
+        while True:
+            wait = self.__take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def release(self):
+        if self.semaphore:
+            self.semaphore.release()
+
+    def pause(self, seconds):
+        '''
+        Hold back all requests for seconds, e.g. after the manager
+        answered 429 Too Many Requests
+        '''
+        with self.lock:
+            self.state[2] = max(self.state[2], time.monotonic() + seconds)
+            self.state[0] = 0
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
 class NsxConnect(requests.Request):
     def __init__(self, server, logger, port = 443, 
                  user='admin', password=None, access_token=None, cookie=None, 
                  content='application/json', accept='application/json',
                  global_infra=False, global_gm=False,
                  site='default', enforcement='default', domain='default',
-                 cert=None, verify=False, timeout=None):
+                 cert=None, verify=False, timeout=None, limiter=None, retries=3,
+                 hedge=None, codec=None):
         '''
         server - The NSX Manager IP or FQDN
         port - TCP port for server
@@ -22,6 +144,19 @@ class NsxConnect(requests.Request):
         password - Password for the user, not required when re-using session
                    or cert auth
         cookie - Session cookiefile
+        limiter - Optional RateLimiter, or threading or multiprocessing
+                  semaphore, that every request to server goes through, can
+                  be shared by multiple NsxConnect instances
+        timeout - Seconds to wait for the server, a (connect, read) tuple
+                  or one value for both.  None waits forever
+        retries - Number of times a request answered with 429 Too Many
+                  Requests or 503 Service Unavailable is retried, after
+                  pausing the limiter
+        hedge - Optional latency percentile, e.g. 95.  A GET still waiting
+                after that percentile of the recent GET latencies is sent
+                a second time, and the first answer is used
+        codec - JSON codec to encode request bodies and decode responses,
+                the fastest available by default, see defaultCodec()
         
         
         '''
@@ -45,6 +180,20 @@ class NsxConnect(requests.Request):
         self.enforcement=enforcement
         self.domain=domain
         self.logger=logger
+        self.limiter=limiter
+        self.retries=retries
+        # number of 429 and 503 responses received, updated under counterLock
+        self.throttled=0
+        self.counterLock=threading.Lock()
+        # time after which requests raise DeadlineExceeded, see setDeadline()
+        self.deadline=None
+        self.deadlineName=None
+        self.codec=codec if codec else defaultCodec()
+        self.hedge=hedge
+        self.hedged=0
+        self.latencies=collections.deque(maxlen=200)
+        self.hedgePool=None
+        self.hedgeLock=threading.Lock()
         self.session = requests.Session()
         
         if self.access_token:
@@ -150,6 +299,119 @@ class NsxConnect(requests.Request):
                                             i['id'],
                                             i['path'] if 'path' in i.keys() else "-"))
                     
+    def setDeadline(self, seconds, name=None):
+        '''
+        Fail requests made more than seconds from now with DeadlineExceeded,
+        and cap the timeout of requests to the time left.  None or 0
+        removes the deadline.  name identifies the phase in the error
+        '''
+        self.deadline = time.time() + seconds if seconds else None
+        self.deadlineName = name
+
+    def __timeout(self, timeout):
+        '''
+        Timeout for a request, capped to the time left before the deadline
+        '''
+        if not self.deadline:
+            return timeout
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            msg = "%s exceeded its deadline" %(self.deadlineName or "Request to %s" %self.server)
+            self.logger.log("ERROR - %s" %msg)
+            raise DeadlineExceeded(msg)
+        if timeout is None:
+            return (remaining, remaining)
+        if isinstance(timeout, tuple):
+            return tuple([min(t, remaining) for t in timeout])
+        return min(timeout, remaining)
+
+    def __hedgeDelay(self):
+        '''
+        Seconds to wait before hedging a GET, None until enough GETs have
+        been timed
+        '''
+        with self.hedgeLock:
+            if len(self.latencies) < 20:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered)-1, int(len(ordered) * self.hedge / 100.0))]
+
+    def __hedgedGet(self, url, **kwargs):
+        '''
+        GET url, sending a second request if the first one is slower than
+        the hedge percentile, and returning the first answer received
+        '''
+        start = time.time()
+        delay = self.__hedgeDelay()
+        if delay is None:
+            r = self.__request('GET', url, **kwargs)
+        else:
+            with self.hedgeLock:
+                if not self.hedgePool:
+                    self.hedgePool = concurrent.futures.ThreadPoolExecutor(max_workers=64)
+            first = self.hedgePool.submit(self.__request, 'GET', url, **kwargs)
+            done, pending = concurrent.futures.wait([first], timeout=delay)
+            if not done:
+                with self.counterLock:
+                    self.hedged += 1
+                self.logger.log("GET %s slower than %.2f seconds, sending hedged request"
+                                %(url, delay))
+                second = self.hedgePool.submit(self.__request, 'GET', url, **kwargs)
+                pending = set([first, second])
+                while pending:
+                    done, pending = concurrent.futures.wait(pending,
+                                                            return_when=concurrent.futures.FIRST_COMPLETED)
+                    f = done.pop()
+                    if not f.exception() or not pending:
+                        break
+                    # that one failed, wait for the other
+            else:
+                f = first
+            r = f.result()
+        with self.hedgeLock:
+            self.latencies.append(time.time() - start)
+        return r
+
+    idempotent = ('GET', 'PATCH', 'PUT', 'DELETE')
+
+    def __request(self, method, url, **kwargs):
+        '''
+        Submit a request through the session, going through self.limiter
+        first if one is set.  429 and 503 responses are retried after the
+        delay in their Retry-After header.  POST is not idempotent and is
+        only retried on a 429 with a Retry-After header, meaning the request
+        was rejected before being processed
+        '''
+        attempt = 0
+        timeout = kwargs.pop('timeout', None)
+        while True:
+            kwargs['timeout'] = self.__timeout(timeout)
+            if not self.limiter:
+                r = self.session.request(method, url, **kwargs)
+            else:
+                with self.limiter:
+                    r = self.session.request(method, url, **kwargs)
+            if r.status_code not in (429, 503):
+                return r
+            with self.counterLock:
+                self.throttled += 1
+            if attempt >= self.retries:
+                return r
+            if method not in self.idempotent \
+               and not (r.status_code == 429 and 'Retry-After' in r.headers):
+                return r
+            attempt += 1
+            try:
+                delay = float(r.headers.get('Retry-After', 1))
+            except ValueError:
+                delay = 1.0
+            self.logger.log("WARN - %s %s rate limited by manager, retrying in %.1f seconds"
+                            %(method, url, delay))
+            if hasattr(self.limiter, 'pause'):
+                self.limiter.pause(delay)
+            else:
+                time.sleep(delay)
+
     def __checkReturnCode(self, result, codes):
         '''
         Checks HTTP requests result.status_code against a list of accepted codes
@@ -175,20 +437,22 @@ class NsxConnect(requests.Request):
         if verbose:
             self.logger.log("API: GET %s" %api)
         if not trial:
-            r = self.session.get(url, timeout=self.timeout,
-                                 **self.requestAttr)
+            if self.hedge:
+                r = self.__hedgedGet(url, timeout=self.timeout, **self.requestAttr)
+            else:
+                r = self.__request('GET', url, timeout=self.timeout,
+                                   **self.requestAttr)
             self.__checkReturnCode(r, codes)
             if verbose:
                 self.logger.log("API result code: %d" % r.status_code)
-                #self.logger.log(json.dumps(json.loads(r.text), indent=4))
         else:
             if verbose:
                 self.logger.log("API not called - in safe mode")
             return None
         if display:
-            self.logger.log(json.loads(r.text), jsonData=True)
+            self.logger.log(r.content.decode())
 
-        return json.loads(r.text)
+        return self.codec.decode(r.content)
 
     def patch(self, api, data=None, verbose=True,trial=False, codes=None):
         '''
@@ -203,13 +467,14 @@ class NsxConnect(requests.Request):
         '''
         api=self.normalizeGmLmApi(api=api)
         url=self.server+api
+        body = self.codec.encode(data)
         if verbose:
             self.logger.log("API: PATCH %s with data:" %url)
-            self.logger.log(json.dumps(data, indent=4))
+            self.logger.log(body.decode())
         if not trial:
-            r = self.session.patch(url,data=json.dumps(data),
-                                   timeout=self.timeout,
-                                   **self.requestAttr)
+            r = self.__request('PATCH', url,data=body,
+                               timeout=self.timeout,
+                               **self.requestAttr)
             if verbose:
                 self.logger.log('PATCH API result code: %d' %r.status_code)
                 if r.text:
@@ -235,18 +500,19 @@ class NsxConnect(requests.Request):
         '''
         api=self.normalizeGmLmApi(api)
         url=self.server+api
+        body = self.codec.encode(data)
         if verbose:
             self.logger.log("API: PUT %s with data:" %url)
-            self.logger.log(json.dumps(data, indent=4))
+            self.logger.log(body.decode())
 
         if not trial:
-            r = self.session.put(url, data=json.dumps(data),
-                                 timeout=self.timeout,
-                                 **self.requestAttr)
+            r = self.__request('PUT', url, data=body,
+                               timeout=self.timeout,
+                               **self.requestAttr)
             self.__checkReturnCode(r, codes)
             if verbose:
                 self.logger.log('result code: %d' %r.status_code)
-                return json.loads(r.text)
+                return self.codec.decode(r.content)
         else:
             if verbose:
                 self.logger.log("API not called - in safe mode")
@@ -265,9 +531,9 @@ class NsxConnect(requests.Request):
         if verbose:
             self.logger.log("API: DELETE %s" %url)
         if not trial:
-            r = self.session.delete(url,timeout=self.timeout,
-                                    data=json.dumps(data), 
-                                    **self.requestAttr)
+            r = self.__request('DELETE', url,timeout=self.timeout,
+                               data=self.codec.encode(data),
+                               **self.requestAttr)
             self.__checkReturnCode(r,codes)
             if verbose:
                 self.logger.log('API DELETE result code: %d' %r.status_code)
@@ -293,20 +559,21 @@ class NsxConnect(requests.Request):
         api=self.normalizeGmLmApi(api)
         url = self.server+api
         self.logger.log(url)
+        body = self.codec.encode(data)
         if verbose:
             self.logger.log("API: POST %s with data" %url)
-            self.logger.log(json.dumps(data, indent=4)) 
+            self.logger.log(body.decode())
         if not trial:
-            r = self.session.post(url, data=json.dumps(data),
-                                  timeout=self.timeout,
-                                  **self.requestAttr)
+            r = self.__request('POST', url, data=body,
+                               timeout=self.timeout,
+                               **self.requestAttr)
             self.__checkReturnCode(r, codes)
             if verbose:
                 self.logger.log('result code: %d' %r.status_code)
-            if r.text:
+            if r.content:
                 if display:
-                    self.logger.log(json.loads(r.text), jsonData=True)
-                return json.loads(r.text)
+                    self.logger.log(r.content.decode())
+                return self.codec.decode(r.content)
             else:
                 return None
         else:
@@ -12,6 +12,13 @@ import ssl
 import OpenSSL
 import json
 import random
+import os
+import getpass
+import hashlib
+import time
+import concurrent.futures
+import connections
+from migrator import Logger
 
 def parseParameters():
 
@@ -19,16 +26,19 @@ def parseParameters():
         description='Arguments to connect to vCenter to add a hosts to a cluster')
     parser.add_argument('-s', '--sourcevc',
                         required = True,
+                        nargs = '+',
                         action = 'store',
-                        help = 'Source Vcenter server name or IP')
+                        help = 'Source Vcenter server names or IPs')
     parser.add_argument('-u', '--user',
                         required=True,
+                        nargs = '+',
                         action='store',
-                        help='User name to connect to vcenter')
+                        help='User name to connect to vcenter, one for all or one per --sourcevc')
     parser.add_argument('-p', '--password',
                         required=True,
+                        nargs = '+',
                         action='store',
-                        help = 'Password for connection to vcenter')
+                        help = 'Password for connection to vcenter, one for all or one per --sourcevc')
 
     parser.add_argument("-n", '--name',
                         required = False,
@@ -42,74 +52,465 @@ def parseParameters():
                         action='store_true',
                         help="Ignore case in match")
     parser.add_argument('-m', '--group',
-                        help="Migration group number, random if not specified")
+                        help="Migration group number, random if not specified. With --chunkSize, prefix of the group ID of each chunk, followed by the chunk number and a hash of its VMs")
+    parser.add_argument('--cache',
+                        help="File to cache the VM inventory in, later runs only retrieve the changes since the last run.  With several vcenters, the vcenter name is appended for each vcenter's file")
+    parser.add_argument('--noRefresh', action='store_true',
+                        help="Select VMs from the --cache file without contacting vcenter")
+    parser.add_argument('--chunkSize', type=int, default=0,
+                        help="Split the VMs into pre_migrate payloads of at most this many VMs, default: 0 for a single payload")
+    parser.add_argument('--mc',
+                        help="IP or FQDN of the MC NSX Manager to submit the payloads to with the pre_migrate API")
+    parser.add_argument('--mcUser', default="admin",
+                        help="User name to connect to MC")
+    parser.add_argument('--mcPassword',
+                        help="Password for mcUser")
+    parser.add_argument('--portMapDir', default="portmaps",
+                        help="Directory to store the port map file of each submitted payload, default: portmaps")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="Number of payloads to submit to MC concurrently, default: 4")
+    parser.add_argument('--connectTimeout', type=float, default=10,
+                        help="Seconds to wait for a connection to MC, default: 10")
+    parser.add_argument('--readTimeout', type=float, default=1800,
+                        help="Seconds to wait for MC to answer a pre_migrate request, default: 1800")
+    parser.add_argument('--logfile', default="getVmInstanceId-log.txt",
+                        help="Filename to store logs of MC submissions")
     args = parser.parse_args()
     return args
 
-def getObjects(inv, vimtype, names, glob=False, ignorecase=False, verbose=False):
+def vmFilterSpec(inv, properties):
     """
-    Get object by name from vcenter inventory
+    PropertyCollector filter spec selecting properties of all VMs in the
+    vcenter inventory through a container view
     """
+    container = inv.viewManager.CreateContainerView(inv.rootFolder, [vim.VirtualMachine], True)
+    traversal = vmodl.query.PropertyCollector.TraversalSpec(name="traverseView",
+                                                            path="view",
+                                                            skip=False,
+                                                            type=vim.view.ContainerView)
+    objSpec = vmodl.query.PropertyCollector.ObjectSpec(obj=container,
+                                                       skip=True,
+                                                       selectSet=[traversal])
+    propSpec = vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine,
+                                                          pathSet=properties,
+                                                          all=False)
+    filterSpec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[objSpec],
+                                                          propSet=[propSpec])
+    return filterSpec, container
 
-    container = inv.viewManager.CreateContainerView(inv.rootFolder, vimtype, True)
-    found=[]
-    for i in container.view:
+def getVmProperties(inv, properties=["name", "config.instanceUuid"], pageSize=1000):
+    """
+    Retrieve properties of all VMs in the vcenter inventory with a single
+    PropertyCollector traversal, paging through the results
+    """
+    filterSpec, container = vmFilterSpec(inv, properties)
+    options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=pageSize)
+
+    pc = inv.propertyCollector
+    vms=[]
+    try:
+        result = pc.RetrievePropertiesEx([filterSpec], options)
+        while result:
+            for obj in result.objects:
+                vm={}
+                vm['moId'] = obj.obj._moId
+                for prop in properties:
+                    vm[prop] = None
+                for prop in obj.propSet:
+                    vm[prop.name] = prop.val
+                vms.append(vm)
+            if not result.token:
+                break
+            result = pc.ContinueRetrievePropertiesEx(result.token)
+    finally:
+        container.Destroy()
+    return vms
+
+class InventoryCache(object):
+    """
+    Local cache of the name and instanceUuid of all VMs of a vcenter,
+    kept up to date with PropertyCollector WaitForUpdatesEx.  The cache
+    file stores the session cookie, the property filter and the version
+    of the last update, so the next run only fetches the changes since
+    then.  If the session expired or the filter is gone, the inventory
+    is reloaded in full on a new session.
+
+    The cache file contains the vcenter session cookie, it is only
+    readable by the owner.
+    """
+    properties = ["name", "config.instanceUuid"]
+
+    def __init__(self, filename, host, user, password, context=None):
+        self.filename = filename
+        self.host = host
+        self.user = user
+        self.password = password
+        self.context = context
+        self.data = None
         try:
-            if verbose:
-                print("Checking %s %s against reference %s" %(i.name, i._moId, name))
-            if not names:
-                return container.view
-            for n in names:
-                if ignorecase:
-                    inn=n.lower()
-                    frm=i.name.lower()
-                else:
-                    inn = n
-                    frm = i.name
-                    
-                if glob and inn in frm:
-                    found.append(i)
-                elif inn == frm:
-                    found.append(i)
-                    if len(found) == len(names):
-                        return found
-        except vmodl.fault.ManagedObjectNotFound:
-            #print("VM %s no longer exist")
-            # This is if object was deleted after container view was created
-            pass
+            with open(filename, "r") as fp:
+                self.data = json.load(fp)
+            if self.data.get('vcenter') != host:
+                self.data = None
+        except (OSError, ValueError):
+            self.data = None
+
+    def vms(self):
+        """
+        The cached VMs in the format of getVmProperties
+        """
+        result=[]
+        for moId, props in self.data['vms'].items():
+            vm={'moId': moId}
+            vm.update(props)
+            result.append(vm)
+        return result
+
+    def save(self):
+        fd = os.open(self.filename + ".tmp", os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as fp:
+            json.dump(self.data, fp)
+        os.replace(self.filename + ".tmp", self.filename)
+
+    def __resume(self):
+        """
+        Reattach to the session and property filter of the cache,
+        None if they are no longer valid
+        """
+        if not self.data or not self.data.get('cookie') or not self.data.get('filter'):
+            return None
+        if self.context:
+            stub = connect.SmartStubAdapter(host=self.host, sslContext=self.context)
+        else:
+            stub = connect.SmartStubAdapter(host=self.host)
+        stub.cookie = self.data['cookie']
+        si = vim.ServiceInstance("ServiceInstance", stub)
+        try:
+            if not si.content.sessionManager.currentSession:
+                return None
+        except vim.fault.NotAuthenticated:
+            return None
+        pcFilter = vmodl.query.PropertyCollector.Filter(self.data['filter'], stub)
+        # raises ManagedObjectNotFound if the filter was destroyed
+        pcFilter.partialUpdates
+        return si, pcFilter
+
+    def __reload(self):
+        """
+        Log in and create a new property filter, the first update
+        returns the full inventory
+        """
+        if self.context:
+            si = connect.SmartConnect(host=self.host, user=self.user, pwd=self.password,
+                                      sslContext=self.context)
+        else:
+            si = connect.SmartConnect(host=self.host, user=self.user, pwd=self.password)
+        inv = si.RetrieveContent()
+        filterSpec, container = vmFilterSpec(inv, self.properties)
+        pcFilter = inv.propertyCollector.CreateFilter(filterSpec, partialUpdates=False)
+        self.data={}
+        self.data['vcenter'] = self.host
+        self.data['cookie'] = si._stub.cookie
+        self.data['filter'] = pcFilter._moId
+        self.data['version'] = ""
+        self.data['vms'] = {}
+        return si, pcFilter
+
+    def __apply(self, updateSet):
+        for fu in updateSet.filterSet:
+            for obj in fu.objectSet:
+                moId = obj.obj._moId
+                if obj.kind == "leave":
+                    self.data['vms'].pop(moId, None)
+                    continue
+                if moId not in self.data['vms']:
+                    self.data['vms'][moId] = {p: None for p in self.properties}
+                for change in obj.changeSet:
+                    if change.op == "remove":
+                        self.data['vms'][moId][change.name] = None
+                    else:
+                        self.data['vms'][moId][change.name] = change.val
+        self.data['version'] = updateSet.version
+
+    def __update(self, si, pageSize=1000):
+        """
+        Apply all the changes since the cached version
+        """
+        pc = si.content.propertyCollector
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0,
+                                                            maxObjectUpdates=pageSize)
+        while True:
+            updateSet = pc.WaitForUpdatesEx(self.data['version'], options)
+            if not updateSet:
+                break
+            self.__apply(updateSet)
+            if not updateSet.truncated:
+                break
+
+    def refresh(self):
+        """
+        Bring the cache up to date with vcenter, returns True if it was
+        updated incrementally, False if it was reloaded
+        """
+        session = None
+        try:
+            session = self.__resume()
+        except (vim.fault.NotAuthenticated, vmodl.fault.ManagedObjectNotFound):
+            session = None
+        if session:
+            try:
+                self.__update(session[0])
+                self.save()
+                return True
+            except (vim.fault.NotAuthenticated, vmodl.fault.ManagedObjectNotFound,
+                    vmodl.query.InvalidCollectorVersion):
+                pass
+        session = self.__reload()
+        self.__update(session[0])
+        self.save()
+        return False
+
+def matchObjects(objs, names, glob=False, ignorecase=False, verbose=False):
+    """
+    Get objects by name from the retrieved vcenter inventory
+    """
+    if not names:
+        return objs
+    if ignorecase:
+        names = [n.lower() for n in names]
+    exact = set(names)
+    found=[]
+    for i in objs:
+        frm = i['name']
+        if frm is None:
+            continue
+        if ignorecase:
+            frm = frm.lower()
+        if verbose:
+            print("Checking %s %s against reference %s" %(i['name'], i['moId'], names))
+        if frm in exact:
+            found.append(i)
+        elif glob and any([n in frm for n in names]):
+            found.append(i)
     return found
 
+def chunkGroupId(uuids, group=None, index=0):
+    """
+    Deterministic group ID for a chunk of VM instance UUIDs, so that the
+    same chunk gets the same ID and port map file on every run.  The hash
+    of the UUIDs is part of the ID with a group as well, so a chunk whose
+    VMs changed doesn't reuse the port map of the previous chunk N
+    """
+    digest = hashlib.sha256(",".join(uuids).encode()).hexdigest()
+    if group:
+        return "%s-%d-%s" %(group, index+1, digest[:8])
+    return digest[:16]
+
+def chunkPayloads(uuids, chunkSize, group=None):
+    """
+    Split the VM instance UUIDs into pre_migrate payloads of at most
+    chunkSize VMs each
+    """
+    uuids = sorted(set(uuids))
+    payloads=[]
+    for i in range(0, len(uuids), chunkSize):
+        data={}
+        data['vm_instance_ids'] = uuids[i:i+chunkSize]
+        data['group_id'] = chunkGroupId(data['vm_instance_ids'], group, len(payloads))
+        payloads.append(data)
+    return payloads
+
+def portMapFile(directory, payload):
+    return os.path.join(directory, "portmap-%s.json" % payload['group_id'])
+
+def preMigrate(mc, payload, directory, logger):
+    """
+    Submit a payload to the MC pre_migrate API and store the port map
+    returned for migrator.py --portMaps
+    """
+    fname = portMapFile(directory, payload)
+    logger.log("Submitting pre_migrate for group %s with %d VMs"
+               %(payload['group_id'], len(payload['vm_instance_ids'])), verbose=True)
+    result = mc.post(api="/api/v1/migration/vmgroup?action=pre_migrate",
+                     data=payload, codes=[200], verbose=False)
+    with open(fname + ".tmp", "w") as fp:
+        json.dump(result, fp, indent=4)
+    os.replace(fname + ".tmp", fname)
+    logger.log("Port map for group %s written to %s" %(payload['group_id'], fname), verbose=True)
+    return fname
+
+def submitPayloads(payloads, args):
+    """
+    Submit the payloads to MC with up to args.concurrency in flight.
+    Payloads with a port map file from a previous run are skipped
+    """
+    logger = Logger(file=args.logfile, verbose=False)
+    if not args.mcPassword:
+        mcPassword = getpass.getpass("Enter the password for %s and user %s"
+                                     %(args.mc, args.mcUser))
+    else:
+        mcPassword = args.mcPassword
+    mc = connections.NsxConnect(server=args.mc, logger=logger,
+                                user=args.mcUser,
+                                password=mcPassword,
+                                cookie=None, cert=None,
+                                global_infra=False, global_gm=False,
+                                site="default",
+                                enforcement="default",
+                                domain="default",
+                                timeout=(args.connectTimeout, args.readTimeout))
+    os.makedirs(args.portMapDir, exist_ok=True)
+
+    pending=[]
+    files=[]
+    for p in payloads:
+        if os.path.exists(portMapFile(args.portMapDir, p)):
+            logger.log("Group %s already has port map %s, skipping"
+                       %(p['group_id'], portMapFile(args.portMapDir, p)), verbose=True)
+            files.append(portMapFile(args.portMapDir, p))
+        else:
+            pending.append(p)
+
+    failed=[]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+        futures = {pool.submit(preMigrate, mc, p, args.portMapDir, logger): p for p in pending}
+        for f in concurrent.futures.as_completed(futures):
+            p = futures[f]
+            try:
+                files.append(f.result())
+            except Exception as e:
+                logger.log("ERROR - pre_migrate for group %s failed: %s" %(p['group_id'], e),
+                           verbose=True)
+                failed.append(p['group_id'])
+
+    logger.log("%d of %d payloads have port maps in %s"
+               %(len(files), len(payloads), args.portMapDir), verbose=True)
+    if failed:
+        logger.log("ERROR - pre_migrate failed for groups: %s, run again to retry"
+                   %", ".join(failed), verbose=True)
+        return False
+    return True
+
+def vcenterCredentials(args):
+    """
+    List of (vcenter, user, password), a single user or password
+    applies to all the vcenters
+    """
+    creds=[]
+    for attr in ['user', 'password']:
+        values = getattr(args, attr)
+        if len(values) not in (1, len(args.sourcevc)):
+            print("Specify one --%s for all vcenters or one per --sourcevc" %attr)
+            return None
+    for n, vc in enumerate(args.sourcevc):
+        user = args.user[n] if len(args.user) > 1 else args.user[0]
+        password = args.password[n] if len(args.password) > 1 else args.password[0]
+        creds.append((vc, user, password))
+    return creds
+
+def collectInventory(vc, user, password, context, args):
+    """
+    Retrieve the VM inventory of a vcenter, from the cache if enabled.
+    Returns the inventory and a status message with the elapsed time
+    """
+    start = time.time()
+    if args.cache:
+        fname = args.cache if len(args.sourcevc) == 1 else "%s.%s" %(args.cache, vc)
+        cache = InventoryCache(fname, host=vc, user=user,
+                               password=password, context=context)
+        if args.noRefresh and cache.data:
+            status = "cached"
+        elif cache.refresh():
+            status = "updated"
+        else:
+            status = "loaded"
+        inventory = cache.vms()
+    else:
+        if context:
+            si = connect.SmartConnect(host=vc, user=user, pwd=password, sslContext=context)
+        else:
+            si = connect.SmartConnect(host=vc, user=user, pwd=password)
+        if not si:
+            raise ConnectionError("Could not connect to vcenter: %s" %vc)
+        atexit.register(connect.Disconnect, si)
+        inventory = getVmProperties(inv = si.RetrieveContent())
+        status = "retrieved"
+    for vm in inventory:
+        vm['vcenter'] = vc
+    return inventory, "%s %d VMs in %.1f seconds" %(status, len(inventory), time.time()-start)
+
+def dedupeUuids(vms):
+    """
+    Instance UUIDs of the VMs, each UUID once in inventory order.  A VM
+    registered in several vcenters is reported and only included once
+    """
+    seen={}
+    uuids=[]
+    for i in vms:
+        uuid = i['config.instanceUuid']
+        if not uuid:
+            continue
+        if uuid in seen:
+            if seen[uuid]['vcenter'] != i['vcenter']:
+                print("VM %s with instanceUuid %s found in vcenter %s and %s, using it once"
+                      %(i['name'], uuid, seen[uuid]['vcenter'], i['vcenter']))
+            continue
+        seen[uuid] = i
+        uuids.append(uuid)
+    return uuids
+
 def main():
     print("This script is not supported by VMware.  Use at your own risk")
     args = parseParameters()
-    password = args.password
+    creds = vcenterCredentials(args)
+    if not creds:
+        return -1
+    context = None
     if hasattr(ssl, 'SSLContext'):
         context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
         context.verify_mode=ssl.CERT_NONE
-        si = connect.SmartConnect(host=args.sourcevc, user=args.user, pwd=password, sslContext=context)
-    else:
-        si = connect.SmartConnect(host=args.sourcevc, user=args.user, pwd=password)
 
-    if not si:
-        print("Could not connect to vcenter: %s " %args.sourcevc)
+    inventory=[]
+    failed=False
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(creds)) as pool:
+        futures = {pool.submit(collectInventory, vc, user, password, context, args): vc
+                   for vc, user, password in creds}
+        results={}
+        for f in concurrent.futures.as_completed(futures):
+            vc = futures[f]
+            try:
+                results[vc], status = f.result()
+                print("Vcenter %s: %s" %(vc, status))
+            except Exception as e:
+                print("Could not retrieve inventory of vcenter %s: %s" %(vc, e))
+                failed=True
+    if failed:
         return -1
-    else:
-        print("Connect to vcenter: %s" %args.sourcevc)
-        atexit.register(connect.Disconnect, si)
+    for vc in args.sourcevc:
+        inventory.extend(results[vc])
+
+    vms = matchObjects(inventory,
+                       glob=args.glob,
+                       ignorecase=args.ignorecase,
+                       names=args.name)
+    uuids = dedupeUuids(vms)
+    if args.chunkSize or args.mc:
+        payloads = chunkPayloads(uuids, args.chunkSize if args.chunkSize else max(1, len(uuids)),
+                                 group=args.group)
+        if not args.mc:
+            print(json.dumps(payloads, indent=4))
+        elif not submitPayloads(payloads, args):
+            return -1
+        return
 
-    vms = getObjects(inv = si.RetrieveContent(),
-                     vimtype=[vim.VirtualMachine],
-                     glob=args.glob,
-                     ignorecase=args.ignorecase,
-                     names=args.name)
     data={}
     data['vm_instance_ids'] = []
     if args.group:
         data['group_id'] = args.group
     else:
         data['group_id'] = random.randint(1,10000)
-    for i in vms:
-        data['vm_instance_ids'].append(i.summary.config.instanceUuid)
+    for i in uuids:
+        data['vm_instance_ids'].append(i)
     print(json.dumps(data, indent=4))
 
 if __name__ == "__main__":
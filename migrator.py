@@ -1,11 +1,26 @@
 #!/usr/bin/env python3
 import sys
 import connections
+import requests
+from catalog import Catalog
+from statedb import StateDb
 import argparse
 import getpass
 import json
 import datetime
 import time
+import gzip
+import copy
+import threading
+import concurrent.futures
+import hashlib
+import os
+import glob
+import urllib.parse
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 class Logger(object):
     def __init__(self, file, mode='a', verbose=False):
@@ -15,8 +30,13 @@ class Logger(object):
             print("Error opening %s for Logger" %file)
             sys.exit()
         self.verbose=verbose
+        self.lock=threading.Lock()
 
     def log(self, entry, jsonData=False, jheader=True, verbose=False):
+        with self.lock:
+            self.__log(entry, jsonData, jheader, verbose)
+
+    def __log(self, entry, jsonData, jheader, verbose):
         t = str(datetime.datetime.utcnow())
         verboseChange=False
         if verbose:
@@ -46,6 +66,62 @@ class Logger(object):
     def close(self):
         self.fp.close()
 
+# errors of a request that never got an answer: connection errors, timeouts
+# and requests made after the phase deadline
+requestErrors = (requests.exceptions.RequestException, connections.DeadlineExceeded)
+
+gzipMagic = b'\x1f\x8b'
+zstdMagic = b'\x28\xb5\x2f\xfd'
+
+def fileCompression(filename, mode="r"):
+    '''
+    Return "gzip", "zstd" or None for a JSON file.  Files are read based on
+    their first bytes, so a compressed file is read whatever its name; files
+    are written compressed if their name ends with .gz, .zst or .zstd
+    '''
+    if 'r' in mode:
+        with open(filename, "rb") as fp:
+            magic = fp.read(4)
+        if magic.startswith(gzipMagic):
+            return "gzip"
+        if magic == zstdMagic:
+            return "zstd"
+        return None
+    if filename.endswith(".gz"):
+        return "gzip"
+    if filename.endswith((".zst", ".zstd")):
+        return "zstd"
+    return None
+
+def openJson(filename, mode="r", compression=None):
+    '''
+    Open a plain, gzip or zstd compressed JSON file in text mode, mode is
+    "r" or "w".  compression is used for files written with a name
+    without a compression extension
+    '''
+    compression = fileCompression(filename, mode) or (compression if 'w' in mode else None)
+    if compression == "gzip":
+        return gzip.open(filename, mode + "t", compresslevel=6)
+    if compression == "zstd":
+        if not zstandard:
+            print("The zstandard package is required to read or write %s" %filename)
+            sys.exit()
+        return zstandard.open(filename, mode + "t")
+    return open(filename, mode)
+
+def readJson(filename):
+    with openJson(filename, "r") as fp:
+        return json.load(fp)
+
+def writeJson(data, filename, indent=None, separators=None, compression=None):
+    '''
+    Stream data as JSON to filename, compressed according to its extension
+    '''
+    with openJson(filename, "w", compression=compression) as fp:
+        json.dump(data, fp, indent=indent, separators=separators)
+        if indent:
+            fp.write("\n")
+
 
 '''
 Holds all the 
@@ -53,13 +129,122 @@ Holds all the
 class NSXT(object):
     def __init__(self, mp, logger, listApi=None,
                  domain='default', site='default',
-                 enforcementPoint='default'):
+                 enforcementPoint='default', snapshot=None, cache=False):
 
         self.mp=mp
         self.listApi=listApi
         self.domain=site
         self.ep=enforcementPoint
         self.logger=logger
+        # dictionary to record every GET response into, see writeSnapshot()
+        self.snapshot=snapshot
+        # per run cache of list() responses by normalized API, and the
+        # events of the requests in flight, see cachedList()
+        self.cache = {} if cache else None
+        self.inflight = {}
+        self.cacheLock = threading.Lock()
+        # indexes of the cached responses by field, see lookup()
+        self.indexes = {}
+
+    def cacheKey(self, api):
+        '''
+        Normalize api for the cache: no trailing slash, sorted query parameters
+        '''
+        api = self.mp.normalizeGmLmApi(api)
+        path, _, query = api.partition('?')
+        path = path.rstrip('/')
+        if not query:
+            return path
+        return "%s?%s" %(path, urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(query, keep_blank_values=True))))
+
+    def cachedList(self, api, mutable=False):
+        '''
+        Return the response of api from the cache, retrieving it if not cached.
+        Concurrent callers for the same api wait for the one request in flight.
+        The cached response is shared and must not be modified, callers that
+        modify it pass mutable=True to get their own copy.
+        '''
+        key = self.cacheKey(api)
+        while True:
+            with self.cacheLock:
+                if key in self.cache:
+                    r = self.cache[key]
+                    return copy.deepcopy(r) if mutable else r
+                event = self.inflight.get(key)
+                if not event:
+                    event = threading.Event()
+                    self.inflight[key] = event
+                    break
+            event.wait()
+        try:
+            r = self.__pageHandler(api=api)
+            with self.cacheLock:
+                # an invalidation while in flight drops our entry
+                if self.inflight.get(key) is event:
+                    self.cache[key] = r
+            return copy.deepcopy(r) if mutable else r
+        finally:
+            with self.cacheLock:
+                if self.inflight.get(key) is event:
+                    del self.inflight[key]
+            event.set()
+
+    def invalidate(self, api=None):
+        '''
+        Drop the cached responses that a write to api may have changed: api
+        itself, the lists that contain it, the objects below it and all
+        queries.  Drops everything if api is None.
+        '''
+        if self.cache is None:
+            return
+        with self.cacheLock:
+            if not api:
+                self.cache.clear()
+                self.inflight.clear()
+                self.indexes.clear()
+                return
+            path = self.cacheKey(api).partition('?')[0]
+            for key in list(self.cache.keys()) + list(self.inflight.keys()):
+                kpath, _, query = key.partition('?')
+                if (query or kpath == path or kpath.startswith(path + '/')
+                    or path.startswith(kpath + '/')):
+                    self.cache.pop(key, None)
+                    self.inflight.pop(key, None)
+                    self.indexes.pop(key, None)
+
+    def lookup(self, api, field, value, removeSearch=True):
+        '''
+        Return the first object listed by api with field equal to value, None
+        if not found.  With the cache enabled, the index of api by field is
+        built once from the cached response and kept until api is invalidated.
+        '''
+        if self.cache is None:
+            data = self.list(api=api, verbose=False, removeSearch=removeSearch)
+            return self.__scan(data, field, value)
+        key = self.cacheKey(api)
+        while True:
+            with self.cacheLock:
+                index = self.indexes.get(key, {}).get(field)
+                if index is None and key in self.cache:
+                    index = {}
+                    for o in self.cache[key].get('results', []):
+                        if field in o and o[field] not in index:
+                            index[o[field]] = o
+                    self.indexes.setdefault(key, {})[field] = index
+                if index is not None:
+                    obj = copy.deepcopy(index.get(value))
+                    break
+            # not cached yet or invalidated in between
+            self.list(api=api, verbose=False)
+        if obj and removeSearch and '/search/query' in api:
+            self.removeStatusFromSearchList(data={'results': [obj]})
+        return obj
+
+    def __scan(self, data, field, value):
+        for o in data['results']:
+            if field in o and o[field] == value:
+                return o
+        return None
 
     def __pageHandler(self, api):
         '''
@@ -77,6 +262,8 @@ class NSXT(object):
                 url = '%s?cursor=%s' % (api,cursor) if cursor else api
 
             r = self.mp.get(api=url, verbose=False,trial=False)
+            if self.snapshot is not None:
+                self.snapshot[url] = copy.deepcopy(r)
             if result:
                 result['results'].extend(r['results'])
             else:
@@ -93,14 +280,26 @@ class NSXT(object):
         req['method'] = "PATCH"
         req['api'] = api
         req['timestamp'] = str(datetime.datetime.utcnow())
-        r = self.mp.patch(api=api,data=data,verbose=True, trial=False)
+        try:
+            r = self.mp.patch(api=api,data=data,verbose=True, trial=False)
+        except requestErrors as e:
+            logger.log("WARN: patch API %s failed: %s" %(api, e))
+            req['status_code'] = 0
+            req['message'] = "%s: %s" %(type(e).__name__, e)
+            self.invalidate(api)
+            return req
+        self.invalidate(api)
         if not r:
             logger.log("WARN: patch API %s returned no status" %api)
             req['status_code'] = 0
             req['message'] = None
         elif r.status_code != 200:
             req['status_code'] = r.status_code
-            req['message'] = json.loads(r.text)
+            try:
+                req['message'] = self.mp.codec.decode(r.content)
+            except ValueError:
+                # not JSON, e.g. the HTML error page of a proxy
+                req['message'] = r.text
             logger.log("WARN: API failed with code %s" % str(r.status_code))
             logger.log("WARN: API failure text: %s" % r.text)
         else:
@@ -108,6 +307,27 @@ class NSXT(object):
             req['message'] = r.text
 
         return req
+
+    def deleteApi(self, api, logger, args):
+        req = {}
+        req['method'] = "DELETE"
+        req['api'] = api
+        req['timestamp'] = str(datetime.datetime.utcnow())
+        try:
+            self.mp.delete(api=api, verbose=True, trial=False, codes=[200])
+            req['status_code'] = 200
+            req['message'] = None
+        except ValueError as e:
+            logger.log("WARN: delete API %s failed: %s" %(api, e))
+            req['status_code'] = 0
+            req['message'] = str(e)
+        except requestErrors as e:
+            logger.log("WARN: delete API %s failed: %s" %(api, e))
+            req['status_code'] = 0
+            req['message'] = "%s: %s" %(type(e).__name__, e)
+        self.invalidate(api)
+
+        return req
     
 
     def jsonPrint(self, data, header=None, indent=4, brief=False):
@@ -141,10 +361,12 @@ class NSXT(object):
 
     def list(self, api=None, brief=False, verbose=True,
              removeSearch=False, searchFields=['status'],
-             header=None):
+             header=None, useCache=True, mutable=False):
         '''
         Returns of a list of NSX objects with api.  The return result will combine
-        multipage results into one
+        multipage results into one.  With the cache enabled, responses are
+        reused unless useCache is False, and are shared between callers unless
+        mutable is True.
         '''
         if not api:
             if self.listApi:
@@ -152,7 +374,11 @@ class NSXT(object):
             else:
                 logger.log("Calling list() without providing API")
                 return None
-        r = self.__pageHandler(api=api)
+        if self.cache is not None and useCache:
+            # removeStatusFromSearchList modifies the response
+            r = self.cachedList(api, mutable or (removeSearch and '/search/query' in api))
+        else:
+            r = self.__pageHandler(api=api)
         if removeSearch and '/search/query' in api:
             r = self.removeStatusFromSearchList(data=r, fields=searchFields)
         if verbose:
@@ -165,48 +391,42 @@ class NSXT(object):
         '''
         Find an nsxobject by display_name
         '''
-        if not data:
-            if not api:
-                if self.listApi:
-                    api=self.listApi
-            if not api:
-                self.logger.log ("Calling list with no API specified")
-                return None
-            data = self.list(api=api,display=False, removeSearch=removeSearch)
-        obj = None
-        for o in data['results']:
-            if o[field] == name:
-                obj = o
-                break
-        if obj and display:
-            if brief:
-                self.logger.log("%d. Name: %s" %(i,obj[field]))
-                self.logger.log("    Id: %s" %(obj['id']))
-            else:
-                self.jsonPrint(data=obj)
-        return obj
-    
+        return self.findByField(field=field, value=name, api=api, data=data,
+                                display=display, brief=brief, removeSearch=removeSearch)
+
     def findById(self, id, api=None, data=None, display=True,brief=False, removeSearch=True):
         '''
         Find an nsxobject by id
         '''
-        if not data:
+        return self.findByField(field='id', value=id, api=api, data=data,
+                                display=display, brief=brief, removeSearch=removeSearch)
+
+    def findByPath(self, path, api=None, data=None, display=True, brief=False, removeSearch=True):
+        '''
+        Find an nsxobject by policy path
+        '''
+        return self.findByField(field='path', value=path, api=api, data=data,
+                                display=display, brief=brief, removeSearch=removeSearch)
+
+    def findByField(self, field, value, api=None, data=None, display=True, brief=False,
+                    removeSearch=True):
+        '''
+        Find an nsxobject by field in data if provided, else through the
+        index of api by field
+        '''
+        if data:
+            obj = self.__scan(data, field, value)
+        else:
             if not api:
                 if self.listApi:
                     api=self.listApi
             if not api:
                 self.logger.log ("Calling list with no API specified")
                 return None
-        data = self.list(api=api,display=False, removeSearch=removeSearch)
-        obj = None
-
-        for o in data['results']:
-            if o['id'] == id:
-                obj = o
-                break
+            obj = self.lookup(api=api, field=field, value=value, removeSearch=removeSearch)
         if obj and display:
             if brief:
-                self.logger.log("%d. Name: %s" %(i,obj['display_name']))
+                self.logger.log("Name: %s" %(obj['display_name']))
                 self.logger.log("   Id: %s" %(obj['id']))
             else:
                 self.jsonPrint(data=obj)
@@ -248,9 +468,332 @@ class NSXT(object):
             return obj['path']
         return None
 
-def parseParameters():
+'''
+Replays the MC GET responses saved with --snapshotOut so that transforms can
+be iterated on without contacting the MC.  Provides the subset of
+connections.NsxConnect used by NSXT for reads.
+'''
+class SnapshotConnect(object):
+    def __init__(self, filename, logger):
+        self.logger=logger
+        self.filename=filename
+        snap = readJson(filename)
+        self.server = snap['mc']
+        self.version = snap['version']
+        self.responses = snap['responses']
+        self.logger.log("Loaded %d MC responses from snapshot %s taken at %s"
+                        %(len(self.responses), filename, snap['timestamp']))
+
+    def normalizeGmLmApi(self, api):
+        return api
+
+    def get(self, api, verbose=True, trial=False, codes=None, display=False):
+        if verbose:
+            self.logger.log("API: GET %s (snapshot)" %api)
+        if api not in self.responses:
+            self.logger.log("WARN - API %s not found in snapshot %s" %(api, self.filename))
+            r = {'error_code': 404,
+                 'error_message': "API %s not found in snapshot" %api}
+        else:
+            # callers modify results in place, never hand out the stored copy
+            r = copy.deepcopy(self.responses[api])
+        if codes:
+            code = r['error_code'] if 'error_code' in r else 200
+            if code not in codes:
+                raise ValueError("Return code '%d' not in list of expected codes: %s\n %s"
+                                 %(code, codes, r))
+        return r
+
+    def patch(self, api, data=None, verbose=True, trial=False, codes=None):
+        raise ValueError("Cannot PATCH %s, MC snapshot %s is read only" %(api, self.filename))
+
+    def put(self, api, data=None, verbose=True, trial=False, codes=None):
+        raise ValueError("Cannot PUT %s, MC snapshot %s is read only" %(api, self.filename))
+
+    def post(self, api, data=None, verbose=True, trial=False, codes=None, display=False):
+        raise ValueError("Cannot POST %s, MC snapshot %s is read only" %(api, self.filename))
+
+    def delete(self, api, data=None, verbose=True, trial=False, codes=None):
+        raise ValueError("Cannot DELETE %s, MC snapshot %s is read only" %(api, self.filename))
+
+'''
+Waits for policy objects on NSX to exist or to be realized.  All the paths still
+pending are checked in each round with up to concurrency requests in flight,
+then the next round is scheduled with exponential backoff until the
+overall timeout in seconds is reached.
+'''
+class RealizationWaiter(object):
+    # plan phases whose objects report a consolidated realization status
+    realizedPhases = ['groups']
+
+    def __init__(self, NSX, logger, timeout=600, delay=1, maxDelay=30, concurrency=8,
+                 notFoundRetries=1):
+        '''
+        notFoundRetries - number of times an object that is not found is
+                          checked again before it is failed
+        '''
+        self.NSX=NSX
+        self.logger=logger
+        self.timeout=timeout
+        self.delay=delay
+        self.maxDelay=maxDelay
+        self.concurrency=concurrency
+        self.notFoundRetries=notFoundRetries
+
+    def notFound(self, r):
+        return r.get('httpStatus') == "NOT_FOUND" or r.get('error_code') == 404
+
+    def realizedState(self, path):
+        '''
+        Return the consolidated realization status of path: SUCCESS, IN_PROGRESS,
+        ERROR, NOT_FOUND or UNKNOWN.  An object without a consolidated status
+        has nothing to wait for and is SUCCESS
+        '''
+        try:
+            r = self.NSX.mp.get(api='/policy/api/v1/infra/realized-state/status?intent_path=%s' %path,
+                                verbose=False)
+        except requests.exceptions.RequestException as e:
+            self.logger.log("WARN - realization check of %s failed: %s" %(path, e))
+            return "UNKNOWN"
+        if 'error_code' in r:
+            return "NOT_FOUND" if self.notFound(r) else "UNKNOWN"
+        if 'consolidated_status' not in r:
+            self.logger.log("%s does not report its realization status, not waiting for it" %path)
+            return "SUCCESS"
+        return r['consolidated_status']['consolidated_status']
+
+    def existsState(self, path):
+        try:
+            r = self.NSX.mp.get(api='/policy/api/v1%s' %path, verbose=False)
+        except requests.exceptions.RequestException as e:
+            self.logger.log("WARN - check of %s failed: %s" %(path, e))
+            return "UNKNOWN"
+        if 'error_code' in r:
+            return "NOT_FOUND" if self.notFound(r) else "UNKNOWN"
+        return "SUCCESS"
+
+    def wait(self, paths, check):
+        '''
+        Check paths with check until all return SUCCESS or ERROR, or until
+        the timeout or the phase deadline.  Paths that are still NOT_FOUND
+        after notFoundRetries more checks are failed.  Returns the set of successful
+        paths, the dictionary of failed paths with their state and the set of
+        paths still pending
+        '''
+        pending = set(paths)
+        done = set()
+        failed = {}
+        misses = {}
+        deadline = time.time() + self.timeout
+        delay = self.delay
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            while pending:
+                checked = list(pending)
+                try:
+                    for path, state in zip(checked, pool.map(check, checked)):
+                        if state == "SUCCESS":
+                            done.add(path)
+                            pending.discard(path)
+                        elif state == "ERROR":
+                            failed[path] = state
+                            pending.discard(path)
+                        elif state == "NOT_FOUND":
+                            misses[path] = misses.get(path, 0) + 1
+                            if misses[path] > self.notFoundRetries:
+                                failed[path] = state
+                                pending.discard(path)
+                except connections.DeadlineExceeded as e:
+                    self.logger.log("ERROR - %s with %d objects pending" %(e, len(pending)),
+                                    verbose=True)
+                    break
+                remaining = deadline - time.time()
+                if not pending or remaining <= 0:
+                    break
+                self.logger.log("%d of %d objects pending, checking again in %d seconds"
+                                %(len(pending), len(checked), min(delay, remaining)))
+                time.sleep(min(delay, remaining))
+                delay = min(delay*2, self.maxDelay)
+        return done, failed, pending
+
+    def waitRealized(self, paths):
+        return self.wait(paths, self.realizedState)
+
+    def waitExist(self, paths):
+        return self.wait(paths, self.existsState)
+
+'''
+Adapts the number of API calls in flight to the destination, additive
+increase and multiplicative decrease.  After each window of completed
+calls, the limit is raised by one if the calls were successful and their
+mean latency stayed within latencyFactor of the best window seen so far.
+It is cut by decrease if the manager throttled (429 or 503) or latency
+rose beyond that.  Every change is recorded in the timeline.
+'''
+class ConcurrencyController(object):
+    def __init__(self, initial, maximum, minimum=1, decrease=0.5,
+                 latencyFactor=2.0, throttled=None):
+        '''
+        throttled - optional function returning the number of 429 and 503
+                    responses seen so far, including the ones retried
+        '''
+        self.minimum=max(1, minimum)
+        self.maximum=max(self.minimum, maximum)
+        self.limit=min(max(initial, self.minimum), self.maximum)
+        self.decrease=decrease
+        self.latencyFactor=latencyFactor
+        self.throttled=throttled
+        self.lastThrottled=throttled() if throttled else 0
+        self.inflight=0
+        self.baseline=None
+        self.window=[]
+        self.cond=threading.Condition()
+        self.timeline=[]
+        self.__record("start", None)
+
+    def __record(self, reason, latency):
+        entry={}
+        entry['timestamp'] = str(datetime.datetime.utcnow())
+        entry['concurrency'] = self.limit
+        entry['latency'] = round(latency, 3) if latency is not None else None
+        entry['reason'] = reason
+        self.timeline.append(entry)
+
+    def acquire(self):
+        with self.cond:
+            while self.inflight >= self.limit:
+                self.cond.wait()
+            self.inflight+=1
+
+    def release(self, seconds, status):
+        '''
+        Record a completed call with its latency and HTTP status code
+        '''
+        with self.cond:
+            self.inflight-=1
+            self.window.append((seconds, status))
+            if len(self.window) >= self.limit:
+                self.__adjust()
+            self.cond.notify_all()
+
+    def __adjust(self):
+        calls = len(self.window)
+        latency = sum([w[0] for w in self.window]) / calls
+        errors = len([w for w in self.window if w[1] in (429, 503)])
+        ok = len([w for w in self.window if 200 <= w[1] < 300])
+        if self.throttled:
+            count = self.throttled()
+            errors += count - self.lastThrottled
+            self.lastThrottled = count
+        self.window = []
+        old = self.limit
+        if errors:
+            reason = "throttled"
+            self.limit = max(self.minimum, int(self.limit * self.decrease))
+        elif self.baseline and latency > self.baseline * self.latencyFactor:
+            reason = "latency"
+            self.limit = max(self.minimum, int(self.limit * self.decrease))
+        elif ok * 10 >= calls * 9:
+            reason = "steady"
+            self.limit = min(self.maximum, self.limit + 1)
+        self.baseline = latency if not self.baseline else min(self.baseline, latency)
+        if self.limit != old:
+            self.__record(reason, latency)
+
+    def slot(self):
+        return ControllerSlot(self)
+
+class ControllerSlot(object):
+    '''
+    Context manager holding a slot of a ConcurrencyController for one call,
+    set status before leaving
+    '''
+    def __init__(self, controller):
+        self.controller=controller
+        self.status=0
+
+    def __enter__(self):
+        self.controller.acquire()
+        self.start=time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.controller.release(time.time() - self.start, self.status)
+        return False
+
+class PathTable(object):
+    '''
+    Table of the paths used while rewriting groups and policies.  Each
+    distinct path is stored once as an interned string with an integer ID,
+    and the old to new path mappings of segments, groups, services and
+    context profiles are kept by ID, so rewriting a path is a dict lookup
+    instead of a scan of the group, service or profile lists.
+    '''
+    def __init__(self):
+        self.paths = []
+        self.ids = {}
+        self.mapped = {}
+
+    def id(self, path):
+        pid = self.ids.get(path)
+        if pid is None:
+            pid = len(self.paths)
+            path = sys.intern(path)
+            self.paths.append(path)
+            self.ids[path] = pid
+        return pid
+
+    def intern(self, path):
+        return self.paths[self.id(path)]
+
+    def map(self, kind, old, new):
+        '''
+        Record that path old of kind is replaced by path new
+        '''
+        if kind not in self.mapped:
+            self.mapped[kind] = {}
+        self.mapped[kind][self.id(old)] = self.id(new)
+
+    def lookup(self, kind, old):
+        '''
+        The new path that replaces path old of kind, None if not mapped
+        '''
+        pid = self.ids.get(old)
+        if pid is None or pid not in self.mapped.get(kind, {}):
+            return None
+        return self.paths[self.mapped[kind][pid]]
+
+    def rewrite(self, paths, kinds):
+        '''
+        Interned copy of the list of paths with the paths mapped in any of
+        kinds replaced
+        '''
+        maps = [self.mapped.get(k, {}) for k in kinds]
+        result=[]
+        for pid in map(self.id, paths):
+            for m in maps:
+                if pid in m:
+                    pid = m[pid]
+                    break
+            result.append(self.paths[pid])
+        return result
+
+def writeSnapshot(MC, filename, logger):
+    '''
+    Save all MC GET responses recorded by MC.snapshot into a gzip compressed
+    snapshot file that can be replayed with --snapshotIn
+    '''
+    snap = {}
+    snap['mc'] = MC.mp.server
+    snap['version'] = MC.mp.version
+    snap['timestamp'] = str(datetime.datetime.utcnow())
+    snap['responses'] = MC.snapshot
+    writeJson(snap, filename, compression="gzip")
+    logger.log("Saved %d MC responses to snapshot %s" %(len(MC.snapshot), filename),
+               verbose=True)
+
+def parseParameters(argv=None):
     parser=argparse.ArgumentParser()
-    parser.add_argument("--mc", required=True,
+    parser.add_argument("--mc", required=False,
                         help="IP or FQDN of the NSX node running Migration Coordinator")
     parser.add_argument("--mcUser", required=False,
                         default="admin",
@@ -271,7 +814,7 @@ def parseParameters():
     parser.add_argument("--segmentMap", required=True,
                         help="JSON file mapping destination segments to segments on MC")
     parser.add_argument("--portMaps", required=True, nargs="*",
-                        help="List of map files  with VM portmappings")
+                        help="List of map files, directories of map files or glob patterns with VM portmappings")
     parser.add_argument("--migrationData", required=True,
                         help="File to store migration data and auditing outptus")
     parser.add_argument("--logfile", required=True,
@@ -284,25 +827,141 @@ def parseParameters():
     parser.add_argument("--updateServiceName", required=False,
                         action='store_true',
                         help="Prepend migrated services and context profile names with prefix")
-    args = parser.parse_args()
+    parser.add_argument("--snapshotOut", required=False,
+                        help="Save all MC reads to this gzip compressed snapshot file")
+    parser.add_argument("--snapshotIn", required=False,
+                        help="Replay MC reads from a snapshot saved with --snapshotOut instead of connecting to the MC")
+    parser.add_argument("--planOut", required=False,
+                        help="Write the execution plan to this file instead of submitting to destination, use applyplan.py to execute it")
+    parser.add_argument("--batchSize", required=False, type=int, default=0,
+                        help="Maximum number of API calls per plan batch, default 0 for no limit")
+    parser.add_argument("--maxConcurrency", required=False, type=int, default=0,
+                        help="Adapt the number of API calls in flight between 1 and this maximum, starting at --concurrency, based on destination latency and throttling, default: 0 for fixed --concurrency")
+    parser.add_argument("--concurrency", required=False, type=int, default=1,
+                        help="Number of API calls of a batch to submit concurrently, default: 1")
+    parser.add_argument("--realizationTimeout", required=False, type=int, default=600,
+                        help="Seconds to wait for objects to be realized on destination before submitting objects that use them, 0 to not wait, default: 600")
+    parser.add_argument("--catalog", required=False,
+                        help="Directory of the service and context profile catalog shared by sites migrating to the same destination")
+    parser.add_argument("--stateDb", required=False,
+                        help="SQLite file to also store the migrated objects and their submission results in, for postmigrate.py --stateDb and audit queries")
+    parser.add_argument("--delta", required=False,
+                        help="Migration data file of a previous run, only submit objects added, changed or deleted on the MC since then")
+    parser.add_argument("--deleteRemoved", required=False, action='store_true',
+                        help="With --delta, delete the objects migrated by the previous run that no longer exist on the MC, ports are never deleted")
+    parser.add_argument("--noCache", required=False, action='store_true',
+                        help="Don't reuse GET responses from MC and destination NSX within the run")
+    parser.add_argument("--connectTimeout", required=False, type=float, default=10,
+                        help="Seconds to wait for a connection to MC or destination NSX, default: 10")
+    parser.add_argument("--readTimeout", required=False, type=float, default=300,
+                        help="Seconds to wait for MC or destination NSX to answer a request, default: 300")
+    parser.add_argument("--phaseTimeout", required=False, type=float, default=0,
+                        help="Seconds each phase (fetch, services, contexts, groups, policies, submit) may take before the run is aborted, default: 0 for no limit")
+    parser.add_argument("--hedgePercentile", required=False, type=float, default=0,
+                        help="Send a second GET when a GET takes longer than this percentile of recent GETs, e.g. 95, default: 0 to not send hedged requests")
+    parser.add_argument("--mcRate", required=False, type=float, default=0,
+                        help="Maximum requests per second to MC, default: 0 for no limit")
+    parser.add_argument("--mcConcurrency", required=False, type=int, default=0,
+                        help="Maximum requests in flight to MC, default: 0 for no limit")
+    parser.add_argument("--nsxRate", required=False, type=float, default=0,
+                        help="Maximum requests per second to destination NSX, default: 0 for no limit")
+    parser.add_argument("--nsxConcurrency", required=False, type=int, default=0,
+                        help="Maximum requests in flight to destination NSX, default: 0 for no limit")
+    args = parser.parse_args(argv)
+    if not args.mc and not args.snapshotIn:
+        parser.error("one of --mc or --snapshotIn is required")
+    if args.snapshotIn and args.snapshotOut:
+        parser.error("--snapshotIn and --snapshotOut cannot be used together")
     return args
 
 
-def readPortMappings(logger, args):
+portMapKeys = ['VmLports', 'VmSegPortPaths', 'VnicSegPortPaths']
+
+portMapSuffixes = ('.json', '.json.gz', '.json.zst', '.json.zstd')
+
+def portMapFiles(paths, logger=None):
+    '''
+    Expand the --portMaps arguments, each a file, a directory of
+    portmap files or a glob pattern, into a list of files.  Only the .json
+    files of a directory, compressed or not, are taken; dotfiles and other
+    files such as the .tmp files of interrupted writes are skipped
+    '''
+    files=[]
+    for p in paths:
+        if os.path.isdir(p):
+            found=[]
+            for f in sorted(os.listdir(p)):
+                if not os.path.isfile(os.path.join(p, f)):
+                    continue
+                if f.startswith('.') or not f.endswith(portMapSuffixes):
+                    if logger:
+                        logger.log("Skipping %s, not a portmap file" %os.path.join(p, f),
+                                   verbose=True)
+                    continue
+                found.append(os.path.join(p, f))
+        elif glob.has_magic(p):
+            found = sorted([f for f in glob.glob(p) if os.path.isfile(f)])
+        else:
+            found = [p]
+        for f in found:
+            if f not in files:
+                files.append(f)
+    return files
+
+def compactValue(value):
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, list):
+        return [compactValue(v) for v in value]
+    return value
+
+def readPortMapFile(fname):
+    '''
+    Read one portmap file, keeping only the mappings.  Runs in a worker
+    process of readPortMappings
+    '''
+    d = readJson(fname)
+    return {k: d[k] for k in portMapKeys}
+
+def readPortMappings(logger, args, workers=None):
+    '''
+    Read and merge all the portmap files, parsing them in parallel worker
+    processes.  A VM or vNIC mapped differently by two files is reported,
+    the mapping of the file listed last is used.
+    '''
     data={}
-    data['VmLports'] = {}
-    data['VmSegPortPaths'] = {}
-    data['VnicSegPortPaths'] = {}
-
-    for fname in args.portMaps:
-        logger.log("Reading in portmap file %s" %fname)
-        with open(fname, "r") as fp:
-            d = json.load(fp)
-            data['VmLports'].update(d['VmLports'])
-            data['VmSegPortPaths'].update(d['VmSegPortPaths'])
-            data['VnicSegPortPaths'].update(d['VnicSegPortPaths'])
-            
-    return data                                
+    for k in portMapKeys:
+        data[k] = {}
+    origin={}
+    conflicts=0
+
+    files = portMapFiles(args.portMaps, logger)
+    logger.log("Reading in %d portmap files" %len(files), verbose=True)
+    if len(files) > 1 and workers != 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(readPortMapFile, files, chunksize=8)
+            maps = list(zip(files, results))
+    else:
+        maps = [(fname, readPortMapFile(fname)) for fname in files]
+
+    for fname, d in maps:
+        logger.log("Merging portmap file %s" %fname)
+        for k in portMapKeys:
+            merged = data[k]
+            for key, value in d[k].items():
+                if key in merged and merged[key] != value:
+                    conflicts+=1
+                    logger.log("WARN - %s %s is %s in %s and %s in %s, using %s"
+                               %(k, key, merged[key], origin[(k, key)], value, fname, fname),
+                               verbose=True)
+                key = sys.intern(key)
+                merged[key] = compactValue(value)
+                origin[(k, key)] = fname
+    if conflicts:
+        logger.log("WARN - %d conflicting portmap entries found" %conflicts, verbose=True)
+    logger.log("Read %d VMs and %d vNICs from portmap files"
+               %(len(data['VmSegPortPaths']), len(data['VnicSegPortPaths'])), verbose=True)
+    return data
 
 def createNewPortMaps(MC, NSX, segments, portMaps, vms, logger):
     '''
@@ -357,7 +1016,8 @@ def createNewPortMaps(MC, NSX, segments, portMaps, vms, logger):
             logger.log("Segment mapping not found for source segment: %s, %s" %(oldSeg, oldLsp))
             continue
 
-        oldPort=MC.list(api="/policy/api/v1%s"%portMaps['VnicSegPortPaths'][p], verbose=False)
+        oldPort=MC.list(api="/policy/api/v1%s"%portMaps['VnicSegPortPaths'][p], verbose=False,
+                        mutable=True)
         if not oldPort:
             logger.log("Port not found in MC for VM %s %s:%s" %(port['moId'], vmId,vindex))
             return None
@@ -384,7 +1044,7 @@ def createNewPortMaps(MC, NSX, segments, portMaps, vms, logger):
 
 def validateSegments(MC, NSX, logger, args):
     logger.log("Opening segment mapping file: %s" % args.segmentMap)
-    with open(args.segmentMap, "r") as fp:
+    with openJson(args.segmentMap, "r") as fp:
         segments = json.load(fp)
         if 'mappings' not in segments.keys():
             logger.log("Invalid segment mapping file")
@@ -416,15 +1076,72 @@ def validateSegments(MC, NSX, logger, args):
             
     return segments
 
-def processContextProfiles(MC, NSX, logger, args):
+def startPhase(name, conns, args, logger):
+    '''
+    Give the requests of the phase to each of the connections
+    args.phaseTimeout seconds from now
+    '''
+    logger.log("Starting phase %s" %name)
+    for c in conns:
+        if hasattr(c, 'setDeadline'):
+            c.setDeadline(args.phaseTimeout, name="Phase %s" %name)
+
+def prefetch(MC, NSX, logger, catalog=None):
+    '''
+    Retrieve the inventory lists used by the processing phases from MC and
+    the destination concurrently, filling the NSXT caches so the phases
+    don't wait on each list in turn.  The destination services and context
+    profiles are only read on a catalog miss, so they are not prefetched
+    when the catalog is used.
+    '''
+    lists = [(MC, '/policy/api/v1/infra/tags/effective-resources?scope=v_origin&filter_text=Service'),
+             (MC, '/policy/api/v1/infra/tags/effective-resources?scope=v_origin&filter_text=PolicyContextProfile'),
+             (MC, '/policy/api/v1/infra/tags/effective-resources?scope=v_origin&filter_text=Group'),
+             (MC, '/policy/api/v1/infra/tags/effective-resources?scope=v_temporary&filter_text=Group'),
+             (MC, '/policy/api/v1/infra/tags/effective-resources?scope=v_origin&filter_text=SecurityPolicy'),
+             (MC, '/policy/api/v1/infra/segments'),
+             (NSX, '/policy/api/v1/infra/segments'),
+             (NSX, '/policy/api/v1/infra/domains/default/groups')]
+    if not catalog:
+        lists.extend([(NSX, '/policy/api/v1/infra/services'),
+                      (NSX, '/policy/api/v1/infra/context-profiles')])
+    lists = [(mgr, api) for mgr, api in lists if mgr.cache is not None]
+    if not lists:
+        return
+
+    logger.log("Prefetching %d inventory lists from MC and destination" %len(lists), verbose=True)
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(lists)) as pool:
+        futures = {pool.submit(mgr.list, api=api, verbose=False): api for mgr, api in lists}
+        for f in concurrent.futures.as_completed(futures):
+            try:
+                f.result()
+            except Exception as e:
+                # the phase that needs it will read it again
+                logger.log("WARN - prefetch of %s failed: %s" %(futures[f], e))
+    logger.log("Prefetch completed in %.1f seconds" %(time.time() - start), verbose=True)
+
+def catalogUsable(entry, args):
+    '''
+    Catalog entries for objects that were already on the destination can always
+    be used.  Objects created by another site are only reused when names are
+    not being prefixed
+    '''
+    if not entry['prefix'] or entry['prefix'] == args.prefix:
+        return True
+    return not args.updateServiceName
+
+def processContextProfiles(MC, NSX, logger, args, catalog=None):
     logger.log("Retrieving list of context profiles created by Migration Coordinator...")
     vCtx = MC.list(api='/policy/api/v1/infra/tags/effective-resources?scope=v_origin&filter_text=PolicyContextProfile', verbose=False)
 
-    dCtx = NSX.list(api='/policy/api/v1/infra/context-profiles', verbose=False)
+    # only read from destination when the catalog can't resolve a profile
+    dCtx = None
 
     ctxApis={}
     ctxApis['resource'] = "PolicyContextProfile"
     ctxApis['data'] = []
+    ctxApis['matched'] = []
     notFound = 0
     for i in vCtx['results']:
         path=i['path']
@@ -435,10 +1152,23 @@ def processContextProfiles(MC, NSX, logger, args):
             logger.log("WARN skipping migration of /infra/context-profiles/APP_POP2")
             continue
         found=False
-        mcCtx = MC.list(api='/policy/api/v1'+path, verbose=False)
+        mcCtx = MC.list(api='/policy/api/v1'+path, verbose=False, mutable=True)
+        fingerprint = None
+        if catalog:
+            fingerprint = ctxFingerprint(mcCtx, nameCheck=args.serviceNameCheck)
+            entry = catalog.lookup('contexts', fingerprint)
+            if entry and catalogUsable(entry, args):
+                logger.log("Found source ctx: %s in catalog: %s" %(path, entry['path']))
+                ctxApis['matched'].append({'oldPath': path, 'path': entry['path']})
+                continue
+        if dCtx is None:
+            dCtx = NSX.list(api='/policy/api/v1/infra/context-profiles', verbose=False)
         for d in dCtx['results']:
             if compare_ctx(mcCtx, d, nameCheck=args.serviceNameCheck):
                 logger.log("Found source ctx: %s in dest: %s"%(path, d['path']))
+                ctxApis['matched'].append({'oldPath': path, 'path': d['path']})
+                if catalog:
+                    catalog.add('contexts', fingerprint, d['path'], oldPath=path)
                 found=True
                 break
         if not found:
@@ -447,6 +1177,8 @@ def processContextProfiles(MC, NSX, logger, args):
             ctx={}
             ctx['path'], ctx['body'] = transformCtx(mcCtx, args)
             ctx['oldPath'] = mcCtx['path']
+            if fingerprint:
+                ctx['fingerprint'] = fingerprint
             ctxApis['data'].append(ctx)
             notFound+=1
     '''
@@ -486,6 +1218,30 @@ def compare_ctx(src, dst, nameCheck=False):
             break
     return found
 
+def ctxFingerprint(ctx, nameCheck=False):
+    '''
+    Return a fingerprint of the context profile configuration, two profiles
+    with the same fingerprint are equal by compare_ctx()
+    '''
+    attributes=[]
+    for a in ctx['attributes']:
+        attr={}
+        for f in ['attribute_source', 'datatype', 'isAlgType', 'key']:
+            if f in a:
+                attr[f] = a[f]
+        attr['value'] = sorted(a['value'])
+        if 'metadata' in a:
+            attr['metadata'] = sorted([[m['key'], m['value']] for m in a['metadata']])
+        if 'sub_attributes' in a:
+            attr['sub_attributes'] = sorted([json.dumps(sa, sort_keys=True)
+                                             for sa in a['sub_attributes']])
+        attributes.append(attr)
+    data={}
+    data['attributes'] = sorted(attributes, key=lambda a: json.dumps(a, sort_keys=True))
+    if nameCheck:
+        data['display_name'] = ctx['display_name'].lower()
+    return configHash(data)
+
 def compare_attribute_entry(src, dst):
     if src['attribute_source'] != dst['attribute_source']:
         return False
@@ -551,26 +1307,41 @@ def compare_attribute_entry(src, dst):
 
     return True
 
-def processServices(MC, NSX, logger, args):
+def processServices(MC, NSX, logger, args, catalog=None):
 
     logger.log("Retrieving list of services created by Migration Coordinator...")
     VServices = MC.list(api='/policy/api/v1/infra/tags/effective-resources?scope=v_origin&filter_text=Service', verbose=False)
 
-    logger.log("Retrieving list of all services from destination NSX: %s ..." %args.nsx)
-    destServices = NSX.list(api='/policy/api/v1/infra/services', verbose=False)
+    # only read from destination when the catalog can't resolve a service
+    destServices = None
     
     logger.log("Checking to see if destination NSX already has configuration for migrated service")
     notFound = 0
     serviceApis={}
     serviceApis['resource'] = "Service"
     serviceApis['data'] = []
+    serviceApis['matched'] = []
     for i in VServices['results']:
         path = i['path']
         found=False
-        mcService = MC.list(api='/policy/api/v1'+path, verbose=False)
+        mcService = MC.list(api='/policy/api/v1'+path, verbose=False, mutable=True)
+        fingerprint = None
+        if catalog:
+            fingerprint = serviceFingerprint(mcService, nameCheck=args.serviceNameCheck)
+            entry = catalog.lookup('services', fingerprint)
+            if entry and catalogUsable(entry, args):
+                logger.log("Found source: %s in catalog: %s" %(path, entry['path']))
+                serviceApis['matched'].append({'oldPath': path, 'path': entry['path']})
+                continue
+        if destServices is None:
+            logger.log("Retrieving list of all services from destination NSX: %s ..." %args.nsx)
+            destServices = NSX.list(api='/policy/api/v1/infra/services', verbose=False)
         for d in destServices['results']:
             if compare_service(mcService,d, nameCheck=args.serviceNameCheck):
                 logger.log("Found source: %s in dest: %s" %(path,d['path']))
+                serviceApis['matched'].append({'oldPath': path, 'path': d['path']})
+                if catalog:
+                    catalog.add('services', fingerprint, d['path'], oldPath=path)
                 found=True
                 break
         if not found:
@@ -579,6 +1350,8 @@ def processServices(MC, NSX, logger, args):
             svc={}
             svc['path'], svc['body'] = transformService(mcService, args)
             svc['oldPath'] = mcService['path']
+            if fingerprint:
+                svc['fingerprint'] = fingerprint
             serviceApis['data'].append(svc)
             notFound+=1
             #print("Not found: %s" %path)
@@ -589,6 +1362,19 @@ def processServices(MC, NSX, logger, args):
     '''
     return serviceApis
 
+def updateCatalog(catalog, migrationData, prefix):
+    '''
+    Add the services and context profiles successfully created on the
+    destination to the catalog
+    '''
+    for kind in ['services', 'contexts']:
+        for api in migrationData[kind]['data']:
+            if 'fingerprint' not in api or 'migrate' not in api:
+                continue
+            if api['migrate']['successful']:
+                catalog.add(kind, api['fingerprint'], api['path'],
+                            prefix=prefix, oldPath=api['oldPath'])
+
 def updatePathExpressions(expression, newExpr):
     conjOp = {}
     conjOp['conjuunction_operator'] = "OR"
@@ -615,18 +1401,21 @@ def updatePathExpressions(expression, newExpr):
         
         
     
-def updateGroupPaths(groups, logger, args):
+def updateGroupPaths(groups, logger, args, paths=None):
     prefix=args.prefix
+    if paths is None:
+        paths = PathTable()
     logger.log("Updating all groups names, ids and paths with prefix: %s" %prefix)
     for g in groups:
         if 'url' in g:
             comps = g['url'].split('/')
             subPath = "/".join(comps[:-1])
             newPid="%s%s" %(prefix, comps[-1])
-            g['newUrl'] = "%s/%s" %(subPath, newPid)
+            g['newUrl'] = paths.intern("%s/%s" %(subPath, newPid))
             g['api']['newUrl'] = g['newUrl']
             g['api']['body']['id'] = newPid
             g['api']['body']['display_name']  = "%s%s" %(prefix, g['api']['body']['display_name'])
+            paths.map('group', g['url'], g['newUrl'])
 
             if 'temp_apis' in g:
                 g['new_temp_paths'] = []
@@ -635,38 +1424,49 @@ def updateGroupPaths(groups, logger, args):
                     comps = tg['url'].split('/')
                     subPath="/".join(comps[:-1])
                     newPid = "%s%s" %(prefix, comps[-1])
-                    tg['newUrl'] = "%s/%s" %(subPath, newPid)
+                    tg['newUrl'] = paths.intern("%s/%s" %(subPath, newPid))
                     tg['body']['id'] = newPid
                     tg['body']['display_name'] = "%s%s" %(prefix, tg['body']['display_name'])
                     g['new_temp_paths'].append(tg['newUrl'])
                     g['new_internal_paths_to_delete'].append(tg['newUrl'])
-                    if 'expression' not in g['api']['body']:
-                        continue
-                    for expr in g['api']['body']['expression']:
-                        if expr['resource_type'] != "PathExpression":
-                            continue
-                        for i in range(len(expr['paths'])):
-                            if expr['paths'][i] == tg['url']:
-                                expr['paths'][i] = tg['newUrl']
-                    if 'expression' not in tg['body']:
-                        continue
+                    paths.map('temp', tg['url'], tg['newUrl'])
 
+    # one pass over the group memberships replaces the paths of all the
+    # groups and temporary groups
     for g in groups:
         if 'expression' not in g['api']['body']:
             continue
         for e in g['api']['body']['expression']:
             if e['resource_type'] == 'PathExpression':
-                for i in range(len(e['paths'])):
-                    if '/infra/domains/default/groups' not in e['paths'][i]:
-                        continue
-                    for gg in groups:
-                        if e['paths'][i] == gg['url']:
-                            e['paths'][i] = gg['newUrl']
-                            
+                e['paths'][:] = paths.rewrite(e['paths'], ['temp', 'group'])
+
     return groups
-                       
-                                                         
-def processGroups(MC, NSX, logger, args):
+
+def mapSegmentPaths(expression, paths, url, logger):
+    '''
+    Replace the segment paths in the path expressions with their mapped
+    destination segments, False if a segment isn't mapped
+    '''
+    for e in expression:
+        if e['resource_type'] != 'PathExpression':
+            continue
+        p = e['paths']
+        for i in range(len(p)):
+            if '/infra/segments/' not in p[i]:
+                continue
+            if '/ports/' in p[i]:
+                continue
+            newSeg = paths.lookup('segment', p[i])
+            if not newSeg:
+                logger.log("Segment mapping not found for %s in group %s" %
+                           (p[i], url))
+                return False
+            logger.log("Replacing segment %s with mapped segment %s in group %s"
+                       %(p[i], newSeg, url))
+            p[i] = newSeg
+    return True
+
+def processGroups(MC, NSX, logger, args, paths=None):
     logger.log("Retrieving list of Groups created by Migration Coordinator...")
     vGroups = MC.list(api='/policy/api/v1/infra/tags/effective-resources?scope=v_origin&filter_text=Group', verbose=False)
     logger.log("Retrieving list of temporary groups created by Migration Coordinator...")
@@ -677,7 +1477,7 @@ def processGroups(MC, NSX, logger, args):
 
     logger.log("Reading in storage.json file: %s" %args.storageJson)
     try:
-        storageJson = open(args.storageJson, "r")
+        storageJson = openJson(args.storageJson, "r")
     except:
         logger.log("Failed to open storage.json file from MC: %s" %args.storageJson)
         return None
@@ -706,6 +1506,15 @@ def processGroups(MC, NSX, logger, args):
     slogger.close()
     '''
     ports = portsApi
+    if paths is None:
+        paths = PathTable()
+    for s in segments['mappings']:
+        paths.map('segment', s['source'], s['destination'])
+    vmMoIds = {}
+    for vm in ports.keys():
+        vmMoIds[ports[vm]['moId']] = vm
+        for n in ports[vm]['vnics']:
+            n['path'] = paths.intern(n['path'])
     # These cover only groups that MC created with temp ipsets
     logger.log("Updating groups with VM and vNIC static memberships")
     for g in groupMappings:
@@ -740,17 +1549,12 @@ def processGroups(MC, NSX, logger, args):
     # there are groups created by MC that that are not covered in storage.json
     # like ipset based groups that don't need temp ipsets
     logger.log("Iterating through all groups created and realized by MC")
+    mappedUrls = set([gm['url'] for gm in groupMappings])
     for g in vGroups['results']:
-        foundGM = False
-        for gm in groupMappings:
-            if g['path'] == gm['url']:
-                # this group is already covered in group mappings
-                foundGM=True
-                continue
-
-        if not foundGM:
+        # groups already covered in group mappings
+        if g['path'] not in mappedUrls:
             logger.log("Group %s not found in storage.json, reading from MC and adding to mappings" %g['path'])
-            newData=MC.list(api="%s%s" % ("/policy/api/v1",g['path']), verbose=False)
+            newData=MC.list(api="%s%s" % ("/policy/api/v1",g['path']), verbose=False, mutable=True)
             newGM ={}
             newGM['url'] = g['path']
             newGM['api'] = {}
@@ -828,12 +1632,10 @@ def processGroups(MC, NSX, logger, args):
             vmExpr['paths'] = []
             for vm in g['AppliedToVmMOID']:
                 found=False
-                for p in ports.keys():
-                    if ports[p]['moId'] == vm:
-                        for n in ports[p]['vnics']:
-                            vmExpr['paths'].append(n['path'])
-                        found = True
-                        break
+                if vm in vmMoIds:
+                    for n in ports[vmMoIds[vm]]['vnics']:
+                        vmExpr['paths'].append(n['path'])
+                    found = True
                 if not found:
                     logger.log("WARN Group %s has apply to VM %s that doesn't exist in portlist created by pre_migrate" % (g['url'], vm))
                     return None
@@ -845,58 +1647,21 @@ def processGroups(MC, NSX, logger, args):
     logger.log("Updating segment mappings in groups")
     for g in groupMappings:
         #logger.log(g, jsonData=True)
-        if 'expression' not in g['api']['body']:
-            continue
-        for e in  g['api']['body']['expression']:
-            if e['resource_type'] == 'PathExpression':
-                paths = e['paths']
-                for i in range(len(paths)):
-                    if '/infra/segments/' not in paths[i]:
-                        continue
-                    if '/ports/' in paths[i]:
-                        continue
-                    found=False
-                    for s in segments['mappings']:
-                        if s['source'] == paths[i]:
-                            logger.log("Replacing segment %s with mapped segment %s in group %s"
-                                       %(paths[i], s['destination'], g['url']))
-                            paths[i] = s['destination']
-                            found=True
-                            break
-                    if not found:
-                        logger.log("Segment mapping not found for %s in group %s" %
-                                   (paths[i], g['url']))
-                        return None
-                    
+        if 'expression' in g['api']['body']:
+            if not mapSegmentPaths(g['api']['body']['expression'], paths, g['url'], logger):
+                return None
+
         if 'temp_apis' not in g.keys():
             continue
         for tg in g['temp_apis']:
             if 'expression' not in tg['body']:
                 continue
-            for e in  tg['body']['expression']:
-                if e['resource_type'] == 'PathExpression':
-                    paths = e['paths']
-                    for i in range(len(paths)):
-                        if '/infra/segments/' not in paths[i]:
-                            continue
-                        if '/ports/' in paths[i]:
-                            continue
-                        found=False
-                        for s in segments['mappings']:
-                            if s['source'] == paths[i]:
-                                logger.log("Replacing segment %s with mapped segment %s in group %s"
-                                           %(paths[i], s['destination'], g['url']))
-                                paths[i] = s['destination']
-                                found=True
-                                break
-                            if not found:
-                                logger.log("Segment mapping not found for %s in group %s" %
-                                       (paths[i]), g['url'])
-                                return None
-            
+            if not mapSegmentPaths(tg['body']['expression'], paths, g['url'], logger):
+                return None
+
     # Groups with VM memberships now have port memberships
     # fix paths
-    groupMappings=updateGroupPaths(groupMappings, logger, args)
+    groupMappings=updateGroupPaths(groupMappings, logger, args, paths)
     output={}
     output['groupMappings'] = groupMappings
     output['ports'] = portsApi
@@ -908,38 +1673,42 @@ def processGroups(MC, NSX, logger, args):
     '''
     return output
 
-def findNewGroup(group, grouplist):
+def findNewGroup(group, paths):
     if group == "ANY":
         return group
-    for g in grouplist:
-        if g['url'] == group:
-            return g['newUrl']
-    return None
+    return paths.lookup('group', group)
 
-def findNewService(service, servicelist):
+def findNewService(service, paths):
     if service == "ANY":
         return service
-    for s in servicelist:
-        if s['oldPath'] == service:
-            return s['path']
-    return None
-def findNewProfile(profile, profilelist):
+    return paths.lookup('service', service)
+
+def findNewProfile(profile, paths):
     if profile == "ANY":
         return profile
-    for s in profilelist:
-        if s['oldPath'] == profile:
-            return s['path']
-    return None
+    return paths.lookup('profile', profile)
+
+def processPolicies(MC, NSX, services, contexts, groups, logger, args, waiter, paths=None):
+    if paths is None:
+        paths = PathTable()
+    for g in groups:
+        paths.map('group', g['url'], g['newUrl'])
+    for s in services:
+        paths.map('service', s['oldPath'], s['path'])
+    for c in contexts:
+        paths.map('profile', c['oldPath'], c['path'])
 
-def processPolicies(MC, NSX, services, contexts, groups, logger, args):
     logger.log("Retrieving list of policies created by MC")
     mcPolicies = MC.list(api='/policy/api/v1/infra/tags/effective-resources?scope=v_origin&filter_text=SecurityPolicy', verbose=False)
 
+    # services and ctx profiles not migrated, expected to be on destination
+    preExisting = {}
+
     policiesApi = {}
     policiesApi['resources']='SecurityPolicy'
     policiesApi['data'] = []
     for mcp in mcPolicies['results']:
-        p = MC.list(api="/policy/api/v1%s" %mcp['path'], verbose=False)
+        p = MC.list(api="/policy/api/v1%s" %mcp['path'], verbose=False, mutable=True)
         logger.log("Updating policy %s" %p['path'])
         policyName, policyPath, policyId = transformPath(p['display_name'],
                                                          p['path'],
@@ -969,7 +1738,7 @@ def processPolicies(MC, NSX, services, contexts, groups, logger, args):
                 r.pop('realization_id')
             r['display_name'] = "%s%s" %(args.prefix, r['display_name'])
             for i in range(len(r['source_groups'])):
-                ngrp = findNewGroup(r['source_groups'][i], groups)
+                ngrp = findNewGroup(r['source_groups'][i], paths)
                 if not ngrp:
                     logger.log("WARN Policy %s - can't find group %s for rule source"
                                %(p['path'], r['source_groups'][i]))
@@ -977,7 +1746,7 @@ def processPolicies(MC, NSX, services, contexts, groups, logger, args):
                 else:
                     r['source_groups'][i] = ngrp
             for i in range(len(r['destination_groups'])):
-                ngrp = findNewGroup(r['destination_groups'][i], groups)
+                ngrp = findNewGroup(r['destination_groups'][i], paths)
                 if not ngrp:
                     logger.log("WARN Policy %s - can't find group %s for rule destination"
                                %(p['path'], r['destination_groups'][i]))
@@ -985,7 +1754,7 @@ def processPolicies(MC, NSX, services, contexts, groups, logger, args):
                 else:
                     r['destination_groups'][i] = ngrp
             for i in range(len(r['scope'])):
-                ngrp = findNewGroup(r['scope'][i], groups)
+                ngrp = findNewGroup(r['scope'][i], paths)
                 if not ngrp:
                     logger.log("WARN Policy %s - can't find group %s for rule scope"
                                %(p['path'], r['scope'][i]))
@@ -995,51 +1764,38 @@ def processPolicies(MC, NSX, services, contexts, groups, logger, args):
 
 
             for i in range(len(r['services'])):
-                nsvc = findNewService(r['services'][i], services)
+                nsvc = findNewService(r['services'][i], paths)
                 if not nsvc:
                     logger.log("Policy %s - can't find migrated service %s for rule services...checking destination for pre-existing services"
                                %(p['path'], r['services'][i]))
-                    found = False
-                    attempts = 1
-                    while attempts < 10:
-                        dsvc = NSX.list(api="/policy/api/v1%s" %r['services'][i], verbose=False)
-                        if 'error_code' in dsvc.keys():
-                            logger.log("WARN Policy %s uses a service %s in rule that doesn't exist.  Attempt %d of 10" 
-                                       %(p['path'], r['services'][i], attempt), verbse=True)
-                            if attemt != 10:
-                                logger.log("WARN Sleeping 10 seconds for next attempt to find group realization")
-                                time.sleep(10)
-                                continue
-                            else:
-                                return None
-                        else:
-                            logger.log("Policy %s - pre-existing service %s found"
-                                       %(p['path'], r['services'][i]))
-                            found = True
-                            break
+                    if r['services'][i] not in preExisting:
+                        preExisting[r['services'][i]] = p['path']
                 else:
                     r['services'][i] = nsvc
 
             for i in range(len(r['profiles'])):
-                nsvc = findNewProfile(r['profiles'][i], contexts)
+                nsvc = findNewProfile(r['profiles'][i], paths)
                 if not nsvc:
                     logger.log("Policy %s - can't find migrated context profile  %s for rule ctx...checking destination for pre-existing ctx profiles"
                                %(p['path'], r['profiles'][i]))
-                    found=False
-                    attempts = 1
-                    while attempts < 10:
-                        dsvc = NSX.list(api="/policy/api/v1%s" %r['profiles'][i], verbose=False)
-                        if 'error_code' in dsvc.keys():
-                            logger.log("WARN Policy %s uses a ctx profile %s in rule that doesn't exist, attempt %d of 10"
-                                       %(p['path'], r['profiles'][i], attempt))
-                        
-                            return None
-                    else:
-                        logger.log("Policy %s - pre-existing ctx profile %s found"
-                                   %(p['path'], r['profiles'][i]))
+                    if r['profiles'][i] not in preExisting:
+                        preExisting[r['profiles'][i]] = p['path']
                 else:
                     r['profiles'][i] = nsvc
         policiesApi['data'].append(data)
+
+    if preExisting:
+        logger.log("Checking destination for %d pre-existing services and ctx profiles used in rules"
+                   %len(preExisting), verbose=True)
+        done, failed, pending = waiter.waitExist(preExisting.keys())
+        for path in done:
+            logger.log("Policy %s - pre-existing service or ctx profile %s found"
+                       %(preExisting[path], path))
+        if pending or failed:
+            for path in list(pending) + list(failed):
+                logger.log("WARN Policy %s uses a service or ctx profile %s in rule that doesn't exist"
+                           %(preExisting[path], path), verbose=True)
+            return None
     
     '''
     slogger = Logger(file="newPoliciesApi.json", verbose=False)
@@ -1049,19 +1805,576 @@ def processPolicies(MC, NSX, services, contexts, groups, logger, args):
     return policiesApi                    
 
 def reUpdateMigrationLog(data, filename):
-    slogger=Logger(file=filename, mode="w", verbose=False)
-    slogger.log(data, jsonData=True, jheader=False)
-    slogger.close()
-    
-def main():
-    args = parseParameters()
+    writeJson(data, filename, indent=4)
+
+def expressionPaths(expression):
+    '''
+    Return all the paths referenced by PathExpressions in a group expression,
+    including those inside nested expressions
+    '''
+    paths=[]
+    for e in expression:
+        if e['resource_type'] == 'PathExpression':
+            paths.extend(e['paths'])
+        elif e['resource_type'] == 'NestedExpression':
+            paths.extend(expressionPaths(e['expressions']))
+    return paths
+
+def policyPaths(policy):
+    '''
+    Return all the group, service and context profile paths referenced
+    by a security policy and its rules
+    '''
+    paths=[]
+    if 'scope' in policy:
+        paths.extend(policy['scope'])
+    for r in policy['rules']:
+        for f in ['source_groups', 'destination_groups', 'scope', 'services', 'profiles']:
+            if f in r:
+                paths.extend(r[f])
+    return paths
+
+def planSteps(migrationData):
+    '''
+    Return the list of API call steps needed to migrate migrationData, in
+    order of creation, with the ids of the steps that each depends on
+    '''
+    steps=[]
+    def addStep(phase, path, body, ref, refs=[]):
+        step={}
+        step['id'] = len(steps)
+        step['phase'] = phase
+        step['method'] = "PATCH"
+        step['api'] = "/policy/api/v1" + path
+        step['path'] = path
+        step['body'] = body
+        step['ref'] = ref
+        step['refs'] = refs
+        steps.append(step)
+
+    # order of creation: services->ctx profiles->ports->groups->policies
+    for i, api in enumerate(migrationData['services']['data']):
+        addStep('services', api['path'], api['body'], ['services', i])
+    for i, api in enumerate(migrationData['contexts']['data']):
+        addStep('contexts', api['path'], api['body'], ['contexts', i])
+    for vm in migrationData['ports']:
+        if vm == 'failedSubmissions':
+            continue
+        for i, v in enumerate(migrationData['ports'][vm]['vnics']):
+            addStep('ports', v['path'], v['data'], ['ports', vm, i])
+    for i, gm in enumerate(migrationData['groups']):
+        if 'temp_apis' in gm.keys():
+            for t, tg in enumerate(gm['temp_apis']):
+                refs = expressionPaths(tg['body']['expression']) if 'expression' in tg['body'] else []
+                addStep('groups', tg['newUrl'], tg['body'], ['groups', i, 'temp_apis', t], refs)
+        if 'api' in gm.keys():
+            body = gm['api']['body']
+            refs = expressionPaths(body['expression']) if 'expression' in body else []
+            addStep('groups', gm['api']['newUrl'], body, ['groups', i, 'api'], refs)
+    for i, api in enumerate(migrationData['policies']['data']):
+        addStep('policies', api['path'], api['body'], ['policies', i],
+                policyPaths(api['body']))
+
+    pathSteps = {}
+    for step in steps:
+        pathSteps[step['path']] = step['id']
+    for step in steps:
+        step['deps'] = sorted(set([pathSteps[p] for p in step.pop('refs')
+                                   if p in pathSteps and pathSteps[p] != step['id']]))
+    return steps
+
+def levelPlan(plan, logger):
+    '''
+    Assign each step of the plan a level higher than all of its dependencies,
+    and at least its minLevel if one is set, then assign the batches
+    '''
+    steps = plan['steps']
+    levels={}
+    def level(sid, visiting):
+        if sid in levels:
+            return levels[sid]
+        if sid in visiting:
+            logger.log("WARN - dependency loop found at %s" %steps[sid]['path'], verbose=True)
+            return 0
+        visiting.add(sid)
+        lvl = steps[sid].get('minLevel', 0)
+        for d in steps[sid]['deps']:
+            lvl = max(lvl, level(d, visiting)+1)
+        visiting.discard(sid)
+        levels[sid] = lvl
+        return lvl
+
+    for step in steps:
+        step['level'] = level(step['id'], set())
+    batches = planBatches(plan)
+    for n, batch in enumerate(batches):
+        for sid in batch:
+            steps[sid]['batch'] = n
+    return batches
+
+def compilePlan(migrationData, logger, args):
+    '''
+    Compile the migration data into an ordered execution plan.  Each step is one
+    API call with the steps it depends on.  Steps are assigned a level so that
+    all dependencies of a step are in a lower level, then the steps of each
+    level are split into batches of args.batchSize.  All the steps in a batch
+    are independent of each other and can be submitted concurrently.
+
+    plan:
+       {
+          'steps': [
+              {
+                 'id': 0,
+                 'phase': 'services',
+                 'method': 'PATCH',
+                 'api': '/policy/api/v1/infra/services/...',
+                 'body': {},
+                 'deps': [],
+                 'level': 0,
+                 'batch': 0,
+                 'ref': ['services', 0]
+              }
+          ]
+       }
+    '''
+    plan={}
+    plan['timestamp'] = str(datetime.datetime.utcnow())
+    plan['nsx'] = args.nsx
+    plan['prefix'] = args.prefix
+    plan['batchSize'] = args.batchSize
+    plan['steps'] = planSteps(migrationData)
+    batches = levelPlan(plan, logger)
+    logger.log("Compiled plan with %d API calls in %d batches"
+               %(len(plan['steps']), len(batches)), verbose=True)
+    return plan
+
+def entityChanged(body, prevBody):
+    '''
+    Returns True if the MC revision of an entity has changed, or if its
+    transformed configuration differs from what was previously submitted
+    '''
+    for f in ['_revision', '_last_modified_time']:
+        if body.get(f) != prevBody.get(f):
+            return True
+    strip = lambda b: {k:v for k,v in b.items() if not k.startswith('_')}
+    return strip(body) != strip(prevBody)
+
+def deltaPlan(plan, migrationData, previous, logger, deleteRemoved=False):
+    '''
+    Reduce the plan to the objects that were added or changed on the MC since
+    the previous migration, or that previously failed.  Previously migrated
+    objects that no longer exist on the MC are recorded in
+    migrationData['removed'], and with deleteRemoved get DELETE steps
+    instead.  Ports are never deleted, they come from the port maps of each
+    run rather than from the MC.  Deletions are done after all other steps:
+    policies, then groups, then their temporary groups, then context
+    profiles and services.  Unchanged objects keep their previous
+    submission results.
+    '''
+    prevSteps = {}
+    for s in planSteps(previous):
+        prevSteps[s['path']] = s
+
+    delta = {'added': 0, 'changed': 0, 'unchanged': 0, 'deleted': 0}
+    keep=[]
+    current=set()
+    # objects resolved to existing destination objects are still in use
+    for kind in ['services', 'contexts']:
+        for m in migrationData[kind].get('matched', []):
+            current.add(m['path'])
+    for step in plan['steps']:
+        current.add(step['path'])
+        prev = prevSteps.get(step['path'])
+        if not prev:
+            delta['added']+=1
+            keep.append(step)
+            continue
+        prevResult = getMigrateResult(previous, prev['ref'])
+        if prevResult and prevResult['successful'] \
+           and not entityChanged(step['body'], prev['body']):
+            setMigrateResult(migrationData, step['ref'], prevResult)
+            delta['unchanged']+=1
+            continue
+        logger.log("%s %s changed since previous migration" %(step['phase'], step['path']))
+        delta['changed']+=1
+        keep.append(step)
+
+    ids = {}
+    for n, step in enumerate(keep):
+        ids[step['id']] = n
+        step['id'] = n
+    for step in keep:
+        # dependencies that are not part of the delta already exist on destination
+        step['deps'] = [ids[d] for d in step['deps'] if d in ids]
+    plan['steps'] = keep
+    levelPlan(plan, logger)
+    maxLevel = max([s['level'] for s in keep]) if keep else -1
+
+    removed=[]
+    for prev in prevSteps.values():
+        if prev['path'] in current:
+            continue
+        prevResult = getMigrateResult(previous, prev['ref'])
+        if not prevResult or not prevResult['successful']:
+            continue
+        if prev['phase'] == 'ports':
+            # the port maps of this run may cover other VMs than the previous one
+            continue
+        if prev['phase'] == 'policies':
+            order = 1
+        elif prev['phase'] == 'groups' and prev['ref'][2] == 'api':
+            order = 2
+        elif prev['phase'] == 'groups':
+            order = 3
+        else:
+            order = 4
+        removed.append({'phase': prev['phase'], 'path': prev['path'], 'api': prev['api'],
+                        'order': order})
+    # removed objects that an earlier run did not delete
+    paths = set([r['path'] for r in removed])
+    for r in previous.get('removed', []):
+        if r['path'] not in current and r['path'] not in paths:
+            removed.append(r)
+            paths.add(r['path'])
+
+    migrationData['deleted'] = []
+    migrationData['removed'] = []
+    delta['removed'] = 0
+    for r in sorted(removed, key=lambda r: (r['order'], r['path'])):
+        if not deleteRemoved:
+            logger.log("WARN - %s %s no longer exists on MC, not deleting it without --deleteRemoved"
+                       %(r['phase'], r['path']), verbose=True)
+            migrationData['removed'].append(r)
+            delta['removed']+=1
+            continue
+        logger.log("%s %s no longer exists on MC, deleting from destination"
+                   %(r['phase'], r['path']), verbose=True)
+        deleted={}
+        deleted['phase'] = r['phase']
+        deleted['path'] = r['path']
+        migrationData['deleted'].append(deleted)
+        step={}
+        step['id'] = len(plan['steps'])
+        step['phase'] = r['phase']
+        step['method'] = "DELETE"
+        step['api'] = r['api']
+        step['path'] = r['path']
+        step['body'] = None
+        step['ref'] = ['deleted', len(migrationData['deleted'])-1]
+        step['deps'] = []
+        step['minLevel'] = maxLevel + r['order']
+        plan['steps'].append(step)
+        delta['deleted']+=1
+
+    batches = levelPlan(plan, logger)
+    plan['delta'] = delta
+    logger.log("Delta plan: %d added, %d changed, %d deleted, %d removed not deleted, %d unchanged, %d API calls in %d batches"
+               %(delta['added'], delta['changed'], delta['deleted'], delta['removed'],
+                 delta['unchanged'], len(plan['steps']), len(batches)), verbose=True)
+    return plan
+
+def planBatches(plan, batchSize=None):
+    '''
+    Return the list of batches of step ids in execution order. The steps
+    are grouped by level and each level is split into batches of batchSize,
+    the plan's own batchSize is used if not provided.  A batchSize of
+    0 places each whole level into one batch
+    '''
+    if batchSize is None:
+        batchSize = plan['batchSize']
+    levels={}
+    for step in plan['steps']:
+        levels.setdefault(step['level'], []).append(step['id'])
+    batches=[]
+    for lvl in sorted(levels.keys()):
+        ids = levels[lvl]
+        if not batchSize:
+            batches.append(ids)
+            continue
+        for i in range(0, len(ids), batchSize):
+            batches.append(ids[i:i+batchSize])
+    return batches
+
+def writePlan(plan, filename):
+    writeJson(plan, filename, separators=(',', ':'))
+
+def readPlan(filename):
+    return readJson(filename)
+
+def executeStep(NSX, step, logger, args):
+    if step.get('successful'):
+        # already applied by an earlier run of the plan
+        return True
+    if step['method'] == "DELETE":
+        r = NSX.deleteApi(step['api'], logger, args)
+    else:
+        r = NSX.submitApi(step['api'], step['body'], logger, args)
+    step['result'] = r
+    step['successful'] = r['status_code'] == 200
+    if not step['successful']:
+        logger.log("ERROR - submission of %s %s did not succeed"
+                   %(step['phase'], step['path']), verbose=True)
+    return step['successful']
+
+def executeControlled(NSX, step, logger, args, controller):
+    '''
+    Submit a step in a slot of the ConcurrencyController, reporting its
+    latency and status code
+    '''
+    if step.get('successful'):
+        return True
+    with controller.slot() as slot:
+        try:
+            return executeStep(NSX, step, logger, args)
+        finally:
+            if 'result' in step:
+                slot.status = step['result']['status_code']
+
+def executePlan(NSX, plan, logger, args, concurrency=1, batchSize=None, levelDone=None,
+                waiter=None, controller=None):
+    '''
+    Submit the steps of the plan to NSX batch by batch, with up to concurrency
+    steps of a batch in flight at the same time.  Execution stops after the
+    batch where any failures occurred.  levelDone, if provided, is called
+    whenever all the batches of a level have been submitted.  If a
+    RealizationWaiter is provided, the groups, services and context profiles
+    of a level that later steps depend on must be realized before the next
+    level is submitted.  If a ConcurrencyController is provided, it sets the
+    number of steps in flight instead of concurrency.
+    Returns True if all the steps were submitted successfully
+    '''
+    steps = plan['steps']
+    batches = planBatches(plan, batchSize)
+    needed = set()
+    for step in steps:
+        needed.update(step['deps'])
+    pool = None
+    if controller:
+        logger.log("Executing plan with %d API calls in %d batches, adaptive concurrency %d to %d"
+                   %(len(steps), len(batches), controller.minimum, controller.maximum),
+                   verbose=True)
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=controller.maximum)
+    else:
+        logger.log("Executing plan with %d API calls in %d batches, concurrency %d"
+                   %(len(steps), len(batches), concurrency), verbose=True)
+        if concurrency > 1:
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        for n, batch in enumerate(batches):
+            logger.log("Submitting batch %d of %d with %d API calls"
+                       %(n+1, len(batches), len(batch)), verbose=True)
+            if controller:
+                logger.log("Current concurrency %d" %controller.limit)
+                results = list(pool.map(lambda sid: executeControlled(NSX, steps[sid], logger,
+                                                                      args, controller),
+                                        batch))
+            elif pool:
+                results = list(pool.map(lambda sid: executeStep(NSX, steps[sid], logger, args),
+                                        batch))
+            else:
+                results = [executeStep(NSX, steps[sid], logger, args) for sid in batch]
+            failed = results.count(False)
+            lastOfLevel = n+1 == len(batches) \
+                or steps[batches[n+1][0]]['level'] != steps[batch[0]]['level']
+            if levelDone and (failed or lastOfLevel):
+                levelDone()
+            if failed:
+                logger.log("ERROR: Failure to submit %d APIs in batch %d, stopping"
+                           %(failed, n+1), verbose=True)
+                return False
+            if waiter and lastOfLevel and n+1 < len(batches):
+                lvl = steps[batch[0]]['level']
+                paths = [s['path'] for s in steps if s['level'] == lvl and s['id'] in needed
+                         and s['method'] == "PATCH"
+                         and s['phase'] in waiter.realizedPhases]
+                if paths:
+                    logger.log("Waiting for realization of %d objects used by the next batches"
+                               %len(paths), verbose=True)
+                    done, failedPaths, pending = waiter.waitRealized(paths)
+                    for p in failedPaths:
+                        logger.log("ERROR: %s realization state %s" %(p, failedPaths[p]), verbose=True)
+                    for p in pending:
+                        logger.log("ERROR: %s not realized in %d seconds" %(p, waiter.timeout),
+                                   verbose=True)
+                    if failedPaths or pending:
+                        return False
+    finally:
+        if pool:
+            pool.shutdown()
+    return True
+
+def getMigrateResult(migrationData, ref):
+    '''
+    Return the submission result recorded in migrationData for a plan step ref
+    '''
+    if ref[0] == 'ports':
+        entry = migrationData['ports'][ref[1]]['vnics'][ref[2]]
+    elif ref[0] == 'groups':
+        gm = migrationData['groups'][ref[1]]
+        if 'migrate' not in gm:
+            return None
+        if ref[2] == 'api':
+            return gm['migrate'].get('api')
+        if 'temp_apis' not in gm['migrate']:
+            return None
+        return gm['migrate']['temp_apis'][ref[3]]
+    elif ref[0] == 'deleted':
+        entry = migrationData['deleted'][ref[1]]
+    else:
+        entry = migrationData[ref[0]]['data'][ref[1]]
+    return entry.get('migrate')
+
+def setMigrateResult(migrationData, ref, result):
+    '''
+    Record a submission result in migrationData for a plan step ref, returns
+    the migrationData entry for the step
+    '''
+    if ref[0] == 'ports':
+        entry = migrationData['ports'][ref[1]]['vnics'][ref[2]]
+    elif ref[0] == 'groups':
+        gm = migrationData['groups'][ref[1]]
+        if 'migrate' not in gm:
+            gm['migrate'] = {}
+        if ref[2] == 'api':
+            gm['migrate']['api'] = result
+            return gm['api']
+        if 'temp_apis' not in gm['migrate']:
+            gm['migrate']['temp_apis'] = [None] * len(gm['temp_apis'])
+        gm['migrate']['temp_apis'][ref[3]] = result
+        return gm['temp_apis'][ref[3]]
+    elif ref[0] == 'deleted':
+        entry = migrationData['deleted'][ref[1]]
+    else:
+        entry = migrationData[ref[0]]['data'][ref[1]]
+    entry['migrate'] = result
+    return entry
+
+def recordPlanResults(migrationData, plan):
+    '''
+    Copy the results of executed plan steps back into the migration data
+    '''
+    failed = {}
+    for phase, resource in [('services', 'Service'), ('contexts', 'PolicyContextProfile'),
+                            ('ports', 'SegmentPort'), ('groups', 'Group'),
+                            ('policies', 'SecurityPolicy')]:
+        failed[phase] = {}
+        failed[phase]['resource'] = resource
+        failed[phase]['data'] = []
+
+    for step in plan['steps']:
+        if 'result' not in step:
+            continue
+        result = {}
+        result['successful'] = step['successful']
+        result['apiResult'] = step['result']
+        entry = setMigrateResult(migrationData, step['ref'], result)
+        if not step['successful']:
+            failed[step['phase']]['data'].append(entry)
+
+    migrationData['contexts']['failedSubmissions'] = failed['contexts']
+    migrationData['ports']['failedSubmissions'] = failed['ports']
+    return failed
+
+def resultStatus(result):
+    if not result:
+        return "notSubmitted"
+    return "successful" if result['successful'] else "failed"
+
+def withoutResults(entry):
+    return {k: v for k, v in entry.items() if k != 'migrate'}
+
+def stepOldPath(migrationData, ref):
+    '''
+    Return the MC path of the object of a plan step ref
+    '''
+    if ref[0] == 'ports':
+        return "%s:%s" %(ref[1], migrationData['ports'][ref[1]]['vnics'][ref[2]]['index'])
+    if ref[0] == 'groups':
+        gm = migrationData['groups'][ref[1]]
+        if ref[2] == 'api':
+            return gm['url']
+        return gm['temp_apis'][ref[3]].get('url')
+    if ref[0] == 'deleted':
+        return None
+    return migrationData[ref[0]]['data'][ref[1]].get('oldPath')
+
+def updateStateDb(stateDb, migrationData):
+    '''
+    Save the objects of migrationData and their submission results to the
+    state store
+    '''
+    steps = planSteps(migrationData)
+    for i, deleted in enumerate(migrationData.get('deleted', [])):
+        steps.append({'ref': ['deleted', i], 'phase': deleted['phase'], 'method': "DELETE",
+                      'path': deleted['path'], 'body': None})
+    entities=[]
+    for step in steps:
+        result = getMigrateResult(migrationData, step['ref'])
+        entity={}
+        entity['ref'] = step['ref']
+        entity['type'] = step['phase']
+        entity['method'] = step['method']
+        entity['oldPath'] = stepOldPath(migrationData, step['ref'])
+        entity['newPath'] = step['path']
+        entity['groupId'] = step['ref'][1] if step['ref'][0] == 'groups' else None
+        entity['status'] = resultStatus(result)
+        entity['body'] = step['body']
+        entity['result'] = result
+        entities.append(entity)
+    for kind in ['services', 'contexts']:
+        for i, m in enumerate(migrationData[kind]['matched']):
+            entities.append({'ref': [kind, 'matched', i], 'type': kind, 'method': None,
+                             'oldPath': m['oldPath'], 'newPath': m['path'], 'groupId': None,
+                             'status': "matched", 'body': None, 'result': None})
+
+    groups = [(i, gm['url'], gm['newUrl'], withoutResults(gm))
+              for i, gm in enumerate(migrationData['groups'])]
+    vms=[]
+    for vm, port in migrationData['ports'].items():
+        if vm == 'failedSubmissions':
+            continue
+        vms.append((vm, port.get('moId'),
+                    {'moId': port.get('moId'),
+                     'vnics': [withoutResults(v) for v in port['vnics']]}))
+    stateDb.save(entities, groups, vms)
+
+def updateStateResults(stateDb, plan):
+    '''
+    Save the results of executed plan steps to the state store
+    '''
+    results=[]
+    for step in plan['steps']:
+        if 'result' not in step:
+            continue
+        result = {}
+        result['successful'] = step['successful']
+        result['apiResult'] = step['result']
+        results.append((step['ref'], resultStatus(result), result))
+    stateDb.saveResults(results)
+
+def main(argv=None, nsxLimiter=None):
+    '''
+    argv - migrator.py arguments, sys.argv is used if not provided
+    nsxLimiter - optional connections.RateLimiter for the requests to the
+                 destination NSX, shared with other migrator runs.  Built from
+                 --nsxRate and --nsxConcurrency if not provided
+    '''
+    args = parseParameters(argv)
+    if not nsxLimiter:
+        nsxLimiter = connections.RateLimiter(rate=args.nsxRate, concurrency=args.nsxConcurrency)
     site="default"
     enforcementPoint="default"
     domain="default"
 
     logger = Logger(file=args.logfile, verbose=False)
+
+    if args.delta:
+        logger.log("Reading previous migration data %s" %args.delta, verbose=True)
+        previous = readJson(args.delta)
     
-    if not args.mcPassword:
+    if args.snapshotIn:
+        mcPassword=None
+    elif not args.mcPassword:
         mcPassword = getpass.getpass("Enter the password for %s and user %s"
                                      %(args.mc, args.mcUser))
     else:
@@ -1075,17 +2388,28 @@ def main():
     
                                 
         
-    mc = connections.NsxConnect(server=args.mc, logger=logger,
-                                user=args.mcUser,
-                                password=mcPassword,
-                                cookie=None, cert=None,
-                                global_infra=False, global_gm=False,
-                                site=site,
-                                enforcement=enforcementPoint,
-                                domain=domain,
-                                timeout=None)
-    MC = NSXT(mp=mc, logger=logger,site=site, enforcementPoint=enforcementPoint)
-    logger.log("Connected to %s with user %s" % (args.mc, args.mcUser), verbose=True)
+    if args.snapshotIn:
+        mc = SnapshotConnect(filename=args.snapshotIn, logger=logger)
+        MC = NSXT(mp=mc, logger=logger,site=site, enforcementPoint=enforcementPoint,
+                  cache=not args.noCache)
+        logger.log("Replaying MC %s from snapshot %s" % (mc.server, args.snapshotIn),
+                   verbose=True)
+    else:
+        mc = connections.NsxConnect(server=args.mc, logger=logger,
+                                    user=args.mcUser,
+                                    password=mcPassword,
+                                    cookie=None, cert=None,
+                                    global_infra=False, global_gm=False,
+                                    site=site,
+                                    enforcement=enforcementPoint,
+                                    domain=domain,
+                                    timeout=(args.connectTimeout, args.readTimeout),
+                                    hedge=args.hedgePercentile,
+                                    limiter=connections.RateLimiter(rate=args.mcRate,
+                                                                    concurrency=args.mcConcurrency))
+        MC = NSXT(mp=mc, logger=logger,site=site, enforcementPoint=enforcementPoint,
+                  snapshot={} if args.snapshotOut else None, cache=not args.noCache)
+        logger.log("Connected to %s with user %s" % (args.mc, args.mcUser), verbose=True)
     nsx = connections.NsxConnect(server=args.nsx, logger=logger,
                                  user=args.nsxUser,
                                  password=nsxPassword,
@@ -1094,184 +2418,103 @@ def main():
                                  site=site,
                                  enforcement=enforcementPoint,
                                  domain=domain,
-                                 timeout=None)
+                                 timeout=(args.connectTimeout, args.readTimeout),
+                                 hedge=args.hedgePercentile,
+                                 limiter=nsxLimiter)
 
-    NSX = NSXT(mp=nsx, logger=logger, site=site, enforcementPoint=enforcementPoint)
+    NSX = NSXT(mp=nsx, logger=logger, site=site, enforcementPoint=enforcementPoint,
+               cache=not args.noCache)
     logger.log("Connected to %s with user %s" % (args.nsx, args.nsxUser), verbose=True)
 
-    logger.log("Retrieving list of services created by Migration Coordinator...", verbose=True)
-    VServices = MC.list(api='/policy/api/v1/infra/tags/effective-resources?scope=v_origin&filter_text=Service', verbose=False)
+    catalog = None
+    if args.catalog:
+        catalog = Catalog(directory=args.catalog, nsx=args.nsx, logger=logger)
 
-    logger.log("Retrieving list of all services from destination NSX: %s ..." %args.nsx, verbose=True)
-    destServices = NSX.list(api='/policy/api/v1/infra/services', verbose=False)
+    startPhase("fetch", [mc, nsx], args, logger)
+    prefetch(MC, NSX, logger, catalog)
 
+    logger.log("Retrieving list of services created by Migration Coordinator...", verbose=True)
+    VServices = MC.list(api='/policy/api/v1/infra/tags/effective-resources?scope=v_origin&filter_text=Service', verbose=False)
 
     migrationData={}
     
+    startPhase("services", [mc, nsx], args, logger)
     logger.log("Processing services", verbose=True)
-    serviceApis=processServices(MC, NSX, logger, args)
+    serviceApis=processServices(MC, NSX, logger, args, catalog)
     migrationData['services'] = serviceApis
     
+    startPhase("contexts", [mc, nsx], args, logger)
     logger.log("Processing context profiles", verbose=True)
-    ctxApis = processContextProfiles(MC, NSX, logger, args)
+    ctxApis = processContextProfiles(MC, NSX, logger, args, catalog)
     migrationData['contexts'] = ctxApis
     
+    startPhase("groups", [mc, nsx], args, logger)
     logger.log("Processing ports and groups", verbose=True)
-    groupMappings=processGroups(MC, NSX, logger, args)
+    paths = PathTable()
+    groupMappings=processGroups(MC, NSX, logger, args, paths)
     ports = groupMappings['ports']
     migrationData['groups'] = groupMappings['groupMappings']
     migrationData['ports'] = ports
     
     
+    startPhase("policies", [mc, nsx], args, logger)
     logger.log("Processing Security Policies", verbose=True)
-    policyApis = processPolicies(MC, NSX, serviceApis['data'],
-                               ctxApis['data'], groupMappings['groupMappings'],
-                               logger, args)
+    waiter = RealizationWaiter(NSX, logger, timeout=args.realizationTimeout)
+    policyApis = processPolicies(MC, NSX, serviceApis['data'] + serviceApis['matched'],
+                               ctxApis['data'] + ctxApis['matched'],
+                               groupMappings['groupMappings'],
+                               logger, args, waiter, paths)
 
     if not policyApis:
         logger.log("ERROR - policy")
         system.exit()
     migrationData['policies'] = policyApis
 
-    # order of creation: services->ctx profiles->ports->groups->policies
-    failedApis = {}
-    failedApis['resource'] = 'Service'
-    failedApis['data'] = []
-    logger.log("Submitting services configurations to destination", verbose=True)
-    for api in serviceApis['data']:
-        api['migrate'] = {}
-        url = "/policy/api/v1" + api['path']
-        r = NSX.submitApi(url, api['body'], logger, args)
-        if r['status_code'] != 200:
-            logger.log("ERROR - Submission of Service %s did not succeed" %api['path'])
-            api['migrate']['successful'] = False
-            failedApis['data'].append(api)
-        else:
-            api['migrate']['successful'] = True
-        api['migrate']['apiResult'] = r
-
-
-    if len(failedApis['data']) > 0:
-        logger.log("ERROR: Failure to submit %d service APIs" % len(failedApis['data']),
-                   verbose=True)
-        sys.exit()
-
-    
-    failedApis = {}
-    failedApis['resource'] = 'PolicyContextProfile'
-    failedApis['data'] = []
-    logger.log("Submitting Context Profile configurations to destination", verbose=True)
-    for api in ctxApis['data']:
-        api['migrate'] = {}
-        url = "/policy/api/v1" + api['path']
-        r = NSX.submitApi(url, api['body'], logger, args)
-        if r['status_code'] != 200:
-            logger.log("ERROR - submission for Context Profile %s did not succeed" %api['path'],
-                       verbose=True)
-            api['migrate']['successful'] = False
-            failedApis['data'].append(api)
-        else:
-            api['migrate']['successful'] = True
-            
-        api['migrate']['apiResult'] = r
-    ctxApis['failedSubmissions'] = failedApis
-    reUpdateMigrationLog(migrationData, args.migrationData)
-
-    if len(failedApis['data']) > 0:
-        logger.log("ERROR: Failure to submit %d Context Profile APIs" % len(failedApis['data']),
-                   verbose=True)
-        sys.exit()
-        
-    failedApis = {}
-    failedApis['resource'] = 'SegmentPort'
-    failedApis['data'] = []
-    logger.log("Submitting SegmentPort configurations to destination", verbose=True)
-    for api in ports:
-        port = ports[api]
-        for v in port['vnics']:
-            v['migrate'] = {}
-            url = "/policy/api/v1" + v['path']
-            r = NSX.submitApi(url, v['data'], logger, args)
-
-            if r['status_code'] != 200:
-                logger.log("ERROR - submission for port %s did not succeed" %api['path'],
-                           verbose=True)
-                v['migrate']['successful'] = False
-                failedApis['data'].append(api)
-            else:
-                v['migrate']['successful'] = True
-            v['migrate']['apiResult'] = r
-    reUpdateMigrationLog(migrationData, args.migrationData)
-
-    ports['failedSubmissions'] = failedApis
-    if len(failedApis['data']) > 0:
-        logger.log("ERROR: Failure to submit %d SegmentPort APIs" % len(failedApis['data']),
-                   verbose=True)
-        sys.exit()
-
-    failedApis = {}
-    failedApis['resource'] = 'Group'
-    failedApis['data'] = []
-    # must create temp APIs before main one
-    logger.log("Submitting Group configurations to destination", verbose=True)
-    for gm in groupMappings['groupMappings']:
-        gm['migrate'] = {}
-        if 'temp_apis' in gm.keys():
-            gm['migrate']['temp_apis'] = []
-            for tg in gm['temp_apis']:
-                tgResult={}
-                url = "/policy/api/v1" + tg['newUrl']
-                r = NSX.submitApi(url, tg['body'], logger, args)
-                if r['status_code'] != 200:
-                    logger("ERROR - submission for group %s temp_api %s did not succeed"
-                           %(gm['newUrl'], tg))
-                    tgResult['successful'] = False
-                    failedApis['data'].append(api)
-                else:
-                    tgResult['successful'] = True
-                tgResult['apiResult'] = r
-                gm['migrate']['temp_apis'].append(tgResult)
-                    
-        if 'api' in gm.keys():
-            gm['migrate']['api'] = {}
-            url = "/policy/api/v1" + gm['api']['newUrl']
-            r = NSX.submitApi( url, gm['api']['body'], logger, args)
-            if r['status_code'] != 200:
-                logger.log("ERROR - submission for group %s did not succeed" %gm['api']['newUrl'])
-                gm['migrate']['api']['successful'] = False
-                failedApis['data'].append(gm['api'])
-            else:
-                gm['migrate']['api']['successful'] = True
-            gm['migrate']['api']['apiResult'] = r
-    reUpdateMigrationLog(migrationData, args.migrationData)
-
-
-    if len(failedApis['data']) > 0:
-        logger.log("ERROR: Failure to submit %d Group APIs" % len(failedApis['data']),
-                   verbose=True)
-        sys.exit()
-                
-        
-    failedApis = {}
-    failedApis['resource'] = 'SecurityPolicy'
-    failedApis['data'] = []
-    logger.log("Submitting Security Policy configurations to destination", verbose=True)
-    for api in policyApis['data']:
-        api['migrate'] = {}
-        url = "/policy/api/v1" + api['path']
-        r = NSX.submitApi(url, api['body'], logger, args)
-        if r['status_code'] != 200:
-            logger.log("ERROR - submission for SecurityPolicy %s did not succeed" %api['path'])
-            failedApis['data'] = append(api)
-            api['migrate']['successful'] = False
-        else:
-            api['migrate']['successsful'] = True
-        api['migrate']['apiResult'] = r
-    reUpdateMigrationLog(migrationData, args.migrationData)
-
-    if len(failedApis['data']) > 0:
-        logger.log("ERROR: Failure to submit %d Security Policy APIs" % len(failedApis['data']),
-                   verbose=True)
+    if args.snapshotOut:
+        # all MC reads are done by now
+        writeSnapshot(MC, args.snapshotOut, logger)
+
+    plan = compilePlan(migrationData, logger, args)
+    if args.delta:
+        plan = deltaPlan(plan, migrationData, previous, logger,
+                         deleteRemoved=args.deleteRemoved)
+    stateDb = None
+    if args.stateDb:
+        stateDb = StateDb(args.stateDb, logger)
+        updateStateDb(stateDb, migrationData)
+    if args.planOut:
+        writePlan(plan, args.planOut)
+        reUpdateMigrationLog(migrationData, args.migrationData)
+        logger.log("Execution plan written to %s, nothing submitted to destination"
+                   %args.planOut, verbose=True)
+        return
+
+    controller = None
+    if args.maxConcurrency > args.concurrency:
+        controller = ConcurrencyController(args.concurrency, args.maxConcurrency,
+                                           throttled=lambda: nsx.throttled)
+
+    def levelDone():
+        recordPlanResults(migrationData, plan)
+        if controller:
+            migrationData['concurrency'] = controller.timeline
+        reUpdateMigrationLog(migrationData, args.migrationData)
+        if stateDb:
+            updateStateResults(stateDb, plan)
+
+    if not plan['steps']:
+        # nothing to submit, levelDone won't save the migration data
+        reUpdateMigrationLog(migrationData, args.migrationData)
+
+    startPhase("submit", [mc, nsx], args, logger)
+    logger.log("Submitting configurations to destination", verbose=True)
+    completed = executePlan(NSX, plan, logger, args, concurrency=args.concurrency,
+                            levelDone=levelDone,
+                            waiter=waiter if args.realizationTimeout else None,
+                            controller=controller)
+    if catalog:
+        updateCatalog(catalog, migrationData, args.prefix)
+    if not completed:
         sys.exit()
 
 def transformPath(name, path, Oid, prefix, change=True):
@@ -1343,6 +2586,69 @@ def compare_service(src, dst, nameCheck=False):
             break
     return found
         
+def configHash(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True,
+                                     separators=(',', ':')).encode()).hexdigest()
+
+def serviceFingerprint(svc, nameCheck=False):
+    '''
+    Return a fingerprint of the service configuration, two services with
+    the same fingerprint are equal by compare_service()
+    '''
+    entries=[]
+    for e in svc['service_entries']:
+        entry={}
+        entry['display_name'] = e['display_name'].lower()
+        for f in ['resource_type', 'l4_protocol', 'alg', 'ether_type', 'protocol',
+                  'icmp_type', 'icmp_code', 'protocol_number', 'nested_service_path']:
+            if f in e:
+                entry[f] = e[f]
+        for f in ['source_ports', 'destination_ports']:
+            if f in e:
+                entry[f] = portIntervals(e[f])
+        entries.append(entry)
+    data={}
+    data['service_type'] = svc['service_type']
+    data['service_entries'] = sorted(entries, key=lambda e: json.dumps(e, sort_keys=True))
+    if nameCheck:
+        data['display_name'] = svc['display_name'].lower()
+    return configHash(data)
+
+def portIntervals(ports):
+    '''
+    Normalize a list of port specs, e.g. ["80-85", "86-90", "443"], into a
+    sorted list of merged [start, end] intervals, so that the same ports
+    written differently give the same result
+    '''
+    ranges=[]
+    for spec in ports:
+        for p in str(spec).split(','):
+            p = p.strip()
+            if not p:
+                continue
+            if '-' in p:
+                lo, hi = [int(x) for x in p.split('-', 1)]
+                ranges.append((min(lo, hi), max(lo, hi)))
+            else:
+                ranges.append((int(p), int(p)))
+    ranges.sort()
+    merged=[]
+    for lo, hi in ranges:
+        if merged and lo <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], hi)
+        else:
+            merged.append([lo, hi])
+    return merged
+
+def samePorts(srcEntry, dstEntry):
+    '''
+    True if the two service entries cover the same source and destination ports
+    '''
+    for f in ['source_ports', 'destination_ports']:
+        if portIntervals(srcEntry.get(f, [])) != portIntervals(dstEntry.get(f, [])):
+            return False
+    return True
+
 '''
 Compare two NSX-T service entries.
 Return True if they have the same configuration.
@@ -1361,24 +2667,14 @@ def compare_service_entry(srcEntry, dstEntry, nameCheck=False):
     if srcEntry['resource_type'] == 'L4PortSetServiceEntry':
         if srcEntry['l4_protocol'] != dstEntry['l4_protocol']:
             return False
-        c = [x for x in srcEntry['source_ports'] + dstEntry['source_ports'] if x not in srcEntry['source_ports'] or x not in  dstEntry['source_ports']]
-        if c:
-            return False
-
-        c = [x for x in srcEntry['destination_ports'] + dstEntry['destination_ports'] if x not in srcEntry['destination_ports'] or x not in  dstEntry['destination_ports']]
-        if c:
+        if not samePorts(srcEntry, dstEntry):
             return False
 
     elif srcEntry['resource_type'] == 'ALGTypeServiceEntry':
         if srcEntry['alg'] != dstEntry['alg']:
             return False
         
-        c = [x for x in srcEntry['source_ports'] + dstEntry['source_ports'] if x not in srcEntry['source_ports'] or x not in  dstEntry['source_ports']]
-        if c:
-            return False
-
-        c = [x for x in srcEntry['destination_ports'] + dstEntry['destination_ports'] if x not in srcEntry['destination_ports'] or x not in  dstEntry['destination_ports']]
-        if c:
+        if not samePorts(srcEntry, dstEntry):
             return False
         
     elif srcEntry['resource_type'] == 'EtherTypeServiceEntry':
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+import os
+import sys
+import argparse
+import getpass
+import json
+import time
+import datetime
+import multiprocessing
+import concurrent.futures
+import connections
+import migrator
+
+'''
+Site manifest format:
+{
+    "sites": [
+        {
+            "name": "site1",
+            "mc": "mc1.example.com",
+            "mcUser": "admin",
+            "mcPassword": "optional, prompted for if not present",
+            "prefix": "site1-",
+            "storageJson": "site1/storage.json",
+            "segmentMap": "site1/network_mappings.json",
+            "portMaps": ["site1/portmaps"],
+            "migrationData": "site1/migrationData.json",
+            "logfile": "site1/migrator-log.txt",
+            "args": ["--serviceNameCheck"]
+        }
+    ]
+}
+"name" must be unique in the manifest.
+"args" is an optional list of additional migrator.py arguments for the site.
+'''
+
+def parseParameters():
+    parser=argparse.ArgumentParser()
+    parser.add_argument("--manifest", required=True,
+                        help="JSON file listing the MC sites to migrate")
+    parser.add_argument("--nsx", required=True,
+                        help="IP or FQDN of the destination NSX Manager")
+    parser.add_argument("--nsxUser", required=False,
+                        default="admin",
+                        help="User name to connect to destination NSX Manger")
+    parser.add_argument("--nsxPassword", required=False,
+                        help="Password for nsxUser")
+    parser.add_argument("--workers", required=False, type=int,
+                        help="Number of sites to migrate at the same time, default: all")
+    parser.add_argument("--nsxConcurrency", required=False, type=int, default=8,
+                        help="Maximum number of requests in flight to the destination across all sites, default: 8")
+    parser.add_argument("--nsxRate", required=False, type=float, default=0,
+                        help="Maximum requests per second to the destination across all sites, default: 0 for no limit")
+    parser.add_argument("--report", required=False,
+                        default="multisite-report.json",
+                        help="File to store the consolidated per-site report")
+    args = parser.parse_args()
+    return args
+
+def siteArgs(site, args, nsxPassword):
+    '''
+    Build the migrator.py arguments for a site of the manifest
+    '''
+    argv = ['--mc', site['mc'],
+            '--mcUser', site.get('mcUser', 'admin'),
+            '--mcPassword', site['mcPassword'],
+            '--nsx', args.nsx,
+            '--nsxUser', args.nsxUser,
+            '--nsxPassword', nsxPassword,
+            '--segmentMap', site['segmentMap'],
+            '--migrationData', site['migrationData'],
+            '--logfile', site.get('logfile', "%s-migrator-log.txt" % site['name']),
+            '--prefix', site['prefix']]
+    if 'storageJson' in site:
+        argv.extend(['--storageJson', site['storageJson']])
+    argv.append('--portMaps')
+    argv.extend(site['portMaps'])
+    argv.extend(site.get('args', []))
+    return argv
+
+nsxLimiter = None
+def initWorker(limiter):
+    global nsxLimiter
+    nsxLimiter = limiter
+
+def summarizeSite(migrationData):
+    '''
+    Count the objects of each type that were submitted, failed or
+    not submitted in a site's migration data
+    '''
+    summary={}
+    for step in migrator.planSteps(migrationData):
+        if step['phase'] not in summary:
+            summary[step['phase']] = {'total': 0, 'successful': 0, 'failed': 0, 'notSubmitted': 0}
+        counts = summary[step['phase']]
+        counts['total']+=1
+        result = migrator.getMigrateResult(migrationData, step['ref'])
+        if not result:
+            counts['notSubmitted']+=1
+        elif result['successful']:
+            counts['successful']+=1
+        else:
+            counts['failed']+=1
+    return summary
+
+def runSite(site, argv):
+    '''
+    Migrate one site in a worker process
+    '''
+    report={}
+    report['name'] = site['name']
+    report['mc'] = site['mc']
+    report['prefix'] = site['prefix']
+    report['start'] = str(datetime.datetime.utcnow())
+    start = time.time()
+    try:
+        migrator.main(argv, nsxLimiter=nsxLimiter)
+        report['status'] = "completed"
+    except SystemExit:
+        report['status'] = "failed"
+    except Exception as e:
+        report['status'] = "error"
+        report['message'] = "%s: %s" %(type(e).__name__, e)
+    report['seconds'] = round(time.time() - start, 1)
+    report['summary'] = None
+    try:
+        # a site that fails before writing its migration data would
+        # otherwise report the counts of the previous run
+        if os.path.getmtime(site['migrationData']) < int(start):
+            return report
+        migrationData = migrator.readJson(site['migrationData'])
+        report['summary'] = summarizeSite(migrationData)
+        report['concurrency'] = migrationData.get('concurrency')
+    except (OSError, EOFError, ValueError, KeyError):
+        pass
+    return report
+
+def main():
+    args = parseParameters()
+    with open(args.manifest, "r") as fp:
+        manifest = json.load(fp)
+    sites = manifest['sites']
+    names = [site['name'] for site in sites]
+    duplicates = sorted(set([n for n in names if names.count(n) > 1]))
+    if duplicates:
+        print("Site names must be unique in %s, found duplicates: %s"
+              %(args.manifest, ", ".join(duplicates)))
+        sys.exit(1)
+
+    if not args.nsxPassword:
+        nsxPassword = getpass.getpass("Enter the password for %s and user %s"
+                                     %(args.nsx, args.nsxUser))
+    else:
+        nsxPassword=args.nsxPassword
+    # workers can't prompt, get all the passwords up front
+    for site in sites:
+        if 'mcPassword' not in site:
+            site['mcPassword'] = getpass.getpass("Enter the password for %s and user %s"
+                                                 %(site['mc'], site.get('mcUser', 'admin')))
+
+    limiter = connections.RateLimiter(rate=args.nsxRate, concurrency=args.nsxConcurrency,
+                                      ctx=multiprocessing)
+    workers = args.workers if args.workers else len(sites)
+    print("Migrating %d sites to %s with %d workers, %d destination requests in flight, %s per second"
+          %(len(sites), args.nsx, workers, args.nsxConcurrency,
+            args.nsxRate if args.nsxRate else "no limit"))
+
+    reports=[]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                initializer=initWorker,
+                                                initargs=(limiter,)) as pool:
+        futures = {}
+        for n, site in enumerate(sites):
+            futures[pool.submit(runSite, site, siteArgs(site, args, nsxPassword))] = n
+        for f in concurrent.futures.as_completed(futures):
+            site = sites[futures[f]]
+            try:
+                report = f.result()
+            except Exception as e:
+                report = {'name': site['name'], 'mc': site['mc'], 'prefix': site['prefix'],
+                          'status': "error", 'message': str(e), 'summary': None}
+            print("Site %s (%s) %s" %(report['name'], report['mc'], report['status']))
+            reports.append((futures[f], report))
+
+    # in manifest order
+    reports = [r for n, r in sorted(reports, key=lambda nr: nr[0])]
+    output={}
+    output['nsx'] = args.nsx
+    output['timestamp'] = str(datetime.datetime.utcnow())
+    output['sites'] = reports
+    with open(args.report, "w") as fp:
+        json.dump(output, fp, indent=4)
+
+    print("%-20s %-10s %8s  %s" %("site", "status", "seconds", "submitted/failed/not submitted"))
+    for r in reports:
+        counts = ""
+        if r['summary']:
+            counts = " ".join(["%s:%d/%d/%d" %(p, c['successful'], c['failed'], c['notSubmitted'])
+                               for p, c in r['summary'].items()])
+        print("%-20s %-10s %8s  %s" %(r['name'], r['status'], r.get('seconds', '-'), counts))
+    print("Report written to %s" %args.report)
+    if any([r['status'] != "completed" for r in reports]):
+        sys.exit(1)
+
+if __name__=="__main__":
+    main()
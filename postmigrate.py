@@ -3,9 +3,11 @@ import sys
 import connections
 import argparse
 import getpass
-import json
 import datetime
-from migrator import Logger, NSXT
+import time
+import concurrent.futures
+from migrator import Logger, NSXT, readJson, writeJson, requestErrors
+from statedb import StateDb
 
 def parseParameters():
     parser=argparse.ArgumentParser()
@@ -16,18 +18,42 @@ def parseParameters():
                         help="User name to connect to destination NSX Manger")
     parser.add_argument("--nsxPassword", required=False,
                         help="Password for nsxUser")
-    parser.add_argument("--migrationData", required=True,
+    parser.add_argument("--migrationData", required=False,
                         help="The migration data JSON  file produced by migrator.py")
+    parser.add_argument("--stateDb", required=False,
+                        help="The state store written by migrator.py --stateDb, read instead of --migrationData")
+    parser.add_argument("--groups", required=False, nargs='+',
+                        help="Only clean up these groups, by MC or destination path")
     parser.add_argument("--postData", required=True,
                         help="File to store post migration auditing data")
     parser.add_argument("--prefix", required=True,
                         help="The prefix used for migrator.py")
+    parser.add_argument("--concurrency", required=False, type=int, default=4,
+                        help="Number of group updates or deletion batches to submit concurrently, default: 4")
+    parser.add_argument("--batchSize", required=False, type=int, default=100,
+                        help="Number of temporary groups to delete per hierarchical API request, default: 100")
+    parser.add_argument("--watch", required=False, action='store_true',
+                        help="Clean up each group as soon as all the VMs in its temporary memberships are attached to their segment ports")
+    parser.add_argument("--watchInterval", required=False, type=int, default=60,
+                        help="Seconds between VM attachment checks in watch mode, default: 60")
+    parser.add_argument("--watchTimeout", required=False, type=int, default=0,
+                        help="Seconds to stop watching after, default: 0 to watch until all groups are cleaned up")
+    parser.add_argument("--connectTimeout", required=False, type=float, default=10,
+                        help="Seconds to wait for a connection to destination NSX, default: 10")
+    parser.add_argument("--readTimeout", required=False, type=float, default=300,
+                        help="Seconds to wait for destination NSX to answer a request, default: 300")
+    parser.add_argument("--nsxRate", required=False, type=float, default=0,
+                        help="Maximum requests per second to destination NSX, default: 0 for no limit")
+    parser.add_argument("--nsxConcurrency", required=False, type=int, default=0,
+                        help="Maximum requests in flight to destination NSX, default: 0 for no limit")
     parser.add_argument("--logfile", required=False,
                         default="postmigrate-log.txt",
                         help="The prefix used for migrator.py")
     
     
     args = parser.parse_args()
+    if not args.migrationData and not args.stateDb:
+        parser.error("one of --migrationData or --stateDb is required")
     return args
 
 def addPostMigrateData(entry, group, update):
@@ -60,15 +86,28 @@ def fixExpressions(group, logger):
         logger.log("ERROR - postmigrate - lenght of group %s expression is even"
                    % group['path'], verbose=True)
         logger.log(group, jsonData=True, verbose=True)
-def processGroups(NSX, groupMaps, groups, logger, args):
+def listGroups(NSX, logger, args):
+    logger.log("Retrieving all groups from %s" %args.nsx, verbose=True)
+    return NSX.list(api='/policy/api/v1/infra/domains/default/groups', verbose=False)
+
+def processGroups(NSX, groupMaps, groups, logger, args, destGroups=None):
+    '''
+    destGroups - listing of the destination groups to use instead of
+                 retrieving it
+    '''
+    if destGroups is None:
+        destGroups = listGroups(NSX, logger, args)
+    groupsByPath = {}
+    for g in destGroups['results']:
+        groupsByPath[g['path']] = g
+    migrated = set([g['path'] for g in groups])
+
     for gm in groupMaps['groups']:
-        deleteGroups=[]
         logger.log("Checking group %s for temp groups" %gm['newUrl'], verbose=True)
-        primaryGroup = NSX.list(api='/policy/api/v1'+gm['newUrl'], verbose=False)
-        if 'error_code' in primaryGroup:
+        if gm['newUrl'] not in groupsByPath:
             logger.log("ERROR - cannot find group %s in destination" %gm['newUrl'], verbose=True)
-            logger.log(primaryGroup, jsonData=True, verbose=False)
             continue
+        primaryGroup = groupsByPath[gm['newUrl']]
         
         if 'new_internal_paths_to_delete' not in gm.keys():
             logger.log("Group %s does not have any temporary groups for clean up" % gm['newUrl'], False)
@@ -78,33 +117,32 @@ def processGroups(NSX, groupMaps, groups, logger, args):
         if len(gm['new_internal_paths_to_delete']) != len(gm['temp_apis']):
             logger.log("Group %s paths to delete doesn't equal # of temp apis" % gm['newUrl'], verbose=True)
         if not 'expression' in primaryGroup:
-            logger.log("WARN - Group has %d temporary groups to clean up, but it doesn't have any membership expressions" %(gm['newUrl'], len(gm['new_internal_paths_to_delete'])))
-            addPostMigrateData(gm, primaryGroup, False, gm['new_internal_paths_to_delete'])
+            logger.log("WARN - Group %s has %d temporary groups to clean up, but it doesn't have any membership expressions" %(gm['newUrl'], len(gm['new_internal_paths_to_delete'])))
+            addPostMigrateData(gm, primaryGroup, False)
             continue
 
+        toDelete = set(gm['new_internal_paths_to_delete'])
         for dg in gm['new_internal_paths_to_delete']:
-            found=False
-            for g in groups:
-                if g['path'] == dg:
-                    found=True
-                    deleteGroups.append(dg)
-                    break
-            if not found:
+            if dg not in migrated:
                 logger.log("Temporary group %s not found on NSX: %s"
                            %(dg, args.nsx), verbose=False)
             else:
                 logger.log("Group %s has to delete temp nested group %s"
                            %(gm['newUrl'], dg), verbose=False)
-            found=False
-            for e in primaryGroup['expression']:
-                if e['resource_type'] == 'PathExpression':
-                    if dg in e['paths']:
-                        logger.log("Adding removal of  %s from group %s expressions"
-                                   %(dg, primaryGroup['path']), verbose=True)
-                        e['paths'].remove(dg)
-                        found=True
-                        break
-            if not found:
+
+        removed = set()
+        for e in primaryGroup['expression']:
+            if e['resource_type'] != 'PathExpression':
+                continue
+            paths = [p for p in e['paths'] if p not in toDelete]
+            if len(paths) != len(e['paths']):
+                removed.update(toDelete.intersection(e['paths']))
+                e['paths'] = paths
+        for dg in gm['new_internal_paths_to_delete']:
+            if dg in removed:
+                logger.log("Adding removal of  %s from group %s expressions"
+                           %(dg, primaryGroup['path']), verbose=True)
+            else:
                 logger.log("Group %s has temporary path %s that's not found in its expressions"
                            %(primaryGroup['path'], dg), verbose=True)
         fixExpressions(primaryGroup, logger)
@@ -115,7 +153,63 @@ def processGroups(NSX, groupMaps, groups, logger, args):
 
     return groups
 
+def updateGroup(NSX, gm, logger, args):
+    g = gm['postMigrate']
+    api='/policy/api/v1' + g['url']
+    r = NSX.submitApi( api, g['body'], logger, args)
+    if r['status_code'] != 200:
+        logger.log("ERROR  - change for group %s did not succeeed" %g['url'], verbose=True)
+        g['status']['successful'] = False
+    else:
+        logger.log("Post migrate membership cleanup for %s succeeded" %g['url'])
+        g['status']['successful'] = True
+    g['status']['groupUpdate'].append(r)
+
+def deleteGroupBatch(NSX, batch, logger, args):
+    '''
+    Delete a batch of groups with one hierarchical API request, batch is a list
+    of (temp group path, group mapping) tuples.  If the request fails, the
+    groups are deleted one at a time so each group gets its own status
+    '''
+    domains = {}
+    for dg, gm in batch:
+        comps = dg.split('/')
+        child = {}
+        child['resource_type'] = "ChildGroup"
+        child['marked_for_delete'] = True
+        child['Group'] = {'id': comps[-1], 'resource_type': "Group"}
+        domains.setdefault(comps[3], []).append(child)
+    body = {}
+    body['resource_type'] = "Infra"
+    body['children'] = []
+    for domain in domains:
+        d = {}
+        d['resource_type'] = "ChildDomain"
+        d['marked_for_delete'] = False
+        d['Domain'] = {'id': domain, 'resource_type': "Domain", 'children': domains[domain]}
+        body['children'].append(d)
+
+    logger.log("Deleting %d temporary groups" %len(batch))
+    r = NSX.submitApi('/policy/api/v1/infra', body, logger, args)
+    if r['status_code'] == 200:
+        for dg, gm in batch:
+            gm['postMigrate']['status']['deletions'].append(dg)
+        return
+
+    logger.log("WARN - batch deletion of %d temporary groups failed, deleting one at a time"
+               %len(batch), verbose=True)
+    for dg, gm in batch:
+        logger.log("Deleting temporary group %s" %dg)
+        try:
+            NSX.mp.delete(api='/policy/api/v1'+ dg, verbose=True, codes=[200])
+            gm['postMigrate']['status']['deletions'].append(dg)
+        except (ValueError,) + requestErrors as e:
+            logger.log("ERROR - deletion of temporary group %s failed: %s" %(dg, e), verbose=True)
+            gm['postMigrate']['status']['failedDeletions'].append(dg)
+
 def submitGroups(NSX, data, logger, args):
+    updates=[]
+    cleanups=[]
     for gm in data['groups']:
         if 'postMigrate' not in gm:
             logger.log("WARN - Group %s does not have any post migration data" % gm['newUrl'],
@@ -126,33 +220,46 @@ def submitGroups(NSX, data, logger, args):
         g['status'] = {}
         g['status']['groupUpdate'] = []
         g['status']['deletions'] = []
+        g['status']['failedDeletions'] = []
         if not g['update']:
             logger.log("Group %s does not need post-migration cleanup" % g['url'])
         else:
-            api='/policy/api/v1' + g['url']
-            r = NSX.submitApi( api, g['body'], logger, args)
-            if r['status_code'] != 200:
-                logger.log("ERROR  - change for group %s did not succeeed" %g['url'], verbose=True)
-                g['status']['successful'] = False
-            else:
-                logger.log("Post migrate membership cleanup for %s succeeded" %g['url'])
-                g['status']['successful'] = True
-            g['status']['groupUpdate'].append(r)
-                
+            updates.append(gm)
             
         if 'new_internal_paths_to_delete' not in gm.keys() \
            or len(gm['new_internal_paths_to_delete']) == 0:
             logger.log("Group %s has not temp groups to delete" % gm['newUrl'])
-            
         else:
+            cleanups.append(gm)
+
+    logger.log("Updating %d groups" %len(updates), verbose=True)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(lambda gm: updateGroup(NSX, gm, logger, args), updates))
+
+        try:
+            destGroups = NSX.list(api='/policy/api/v1/infra/domains/default/groups', verbose=False)
+            existing = set([g['path'] for g in destGroups['results']])
+        except requestErrors + (KeyError,) as e:
+            logger.log("ERROR - cannot list groups on %s, not deleting temporary groups: %s"
+                       %(args.nsx, e), verbose=True)
+            cleanups = []
+        deletions=[]
+        for gm in cleanups:
+            g = gm['postMigrate']
+            if g['update'] and not g['status']['successful']:
+                logger.log("Not deleting temporary groups of %s, group update failed" % g['url'],
+                           verbose=True)
+                continue
             for dg in gm['new_internal_paths_to_delete']:
-                tg = NSX.mp.get(api="/policy/api/v1" + dg, verbose=False)
-                if 'error_code' in tg.keys():
+                if dg not in existing:
                     logger.log("Temporary group %s not found for deletion" %dg)
                 else:
-                    logger.log("Deleting temporary group %s" %dg)
-                    NSX.mp.delete(api='/policy/api/v1'+ dg, verbose=True)
-                    g['status']['deletions'].append(dg)
+                    deletions.append((dg, gm))
+
+        batches = [deletions[i:i+args.batchSize] for i in range(0, len(deletions), args.batchSize)]
+        logger.log("Deleting %d temporary groups in %d batches" %(len(deletions), len(batches)),
+                   verbose=True)
+        list(pool.map(lambda b: deleteGroupBatch(NSX, b, logger, args), batches))
 
     '''
     slogger = Logger(file="postMigrateGroupResults.json", verbose=False)
@@ -160,6 +267,146 @@ def submitGroups(NSX, data, logger, args):
     slogger.close()
     '''
     
+def groupAttachments(gm, ports):
+    '''
+    Return the set of attachment ids of the segment ports of all the VMs and
+    vNICs in a group's temporary memberships, and the number of VMs or
+    vNICs whose ports can't be tracked
+    '''
+    attachments=set()
+    untracked=0
+    vnics=[]
+    for vm in gm.get('VirtualMachine', []):
+        if vm not in ports:
+            untracked+=1
+            continue
+        vnics.extend(ports[vm]['vnics'])
+    for vn in gm.get('VirtualNetworkInterface', []) + gm.get('AppliedToVirtualNetworkInterface', []):
+        vmId = "-".join(vn.split('-')[:-1])
+        vIndex = vn.split('-')[-1]
+        if vmId not in ports:
+            untracked+=1
+            continue
+        vnics.extend([v for v in ports[vmId]['vnics'] if v['index'] == vIndex])
+    for moId in gm.get('AppliedToVmMOID', []):
+        found=False
+        for vm in ports:
+            if vm != 'failedSubmissions' and ports[vm]['moId'] == moId:
+                vnics.extend(ports[vm]['vnics'])
+                found=True
+                break
+        if not found:
+            untracked+=1
+    for v in vnics:
+        if 'attachment' in v['data'] and 'id' in v['data']['attachment']:
+            attachments.add(v['data']['attachment']['id'])
+        else:
+            untracked+=1
+    return attachments, untracked
+
+def groupVms(groups):
+    '''
+    Return the VM instance UUIDs and moIds in the temporary memberships of
+    groups, to read only their ports from the state store
+    '''
+    vms=set()
+    moIds=set()
+    for gm in groups:
+        vms.update(gm.get('VirtualMachine', []))
+        for vn in gm.get('VirtualNetworkInterface', []) + gm.get('AppliedToVirtualNetworkInterface', []):
+            vms.add("-".join(vn.split('-')[:-1]))
+        moIds.update(gm.get('AppliedToVmMOID', []))
+    return vms, moIds
+
+def attachedPorts(NSX, vms, vmOf, args):
+    '''
+    Return the set of segment port attachment ids that have a VIF attached,
+    of the VIFs of the VMs with their instance UUID in vms.  The VIFs are
+    listed in one paged query and filtered against vmOf, the VM of each
+    attachment id.  If that listing fails, the VIFs of each VM are queried
+    instead
+    '''
+    vifs = NSX.list(api='/api/v1/fabric/vifs', verbose=False)
+    if 'results' in vifs:
+        return set([v['lport_attachment_id'] for v in vifs['results']
+                    if vmOf.get(v.get('lport_attachment_id')) in vms])
+
+    def vmAttachments(vm):
+        vifs = NSX.list(api='/api/v1/fabric/vifs?owner_vm_id=%s' %vm, verbose=False)
+        return [v['lport_attachment_id'] for v in vifs['results'] if 'lport_attachment_id' in v]
+    attached = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for ids in pool.map(vmAttachments, sorted(vms)):
+            attached.update(ids)
+    return attached
+
+def watchGroups(NSX, groupMaps, migratedGroups, logger, args, stateDb=None):
+    '''
+    Poll the VIF attachments on the destination and clean up each group as
+    soon as all the VMs behind its temporary memberships are attached to
+    their pre-created segment ports.  The groups of each wave are read
+    again before they are cleaned up, as they may have been changed since
+    the watch started.  A poll that fails is retried on the next interval
+    '''
+    ports = groupMaps['ports']
+    vmOf = {}
+    for vm in ports:
+        if vm == 'failedSubmissions':
+            continue
+        for v in ports[vm]['vnics']:
+            if 'attachment' in v['data'] and 'id' in v['data']['attachment']:
+                vmOf[v['data']['attachment']['id']] = vm
+    waiting = {}
+    for gm in groupMaps['groups']:
+        attachments, untracked = groupAttachments(gm, ports)
+        if untracked:
+            logger.log("WARN - Group %s has %d VMs or vNICs without tracked ports, it will not be cleaned up"
+                       %(gm['newUrl'], untracked), verbose=True)
+            continue
+        waiting[gm['newUrl']] = (gm, attachments)
+
+    deadline = time.time() + args.watchTimeout if args.watchTimeout else None
+    wave = 0
+    attached = set()
+    while waiting:
+        ready = []
+        destGroups = None
+        try:
+            unattached = set()
+            for gm, attachments in waiting.values():
+                unattached.update(attachments - attached)
+            attached.update(attachedPorts(NSX, set([vmOf[a] for a in unattached]), vmOf, args))
+            ready = [gm for gm, attachments in waiting.values() if attachments <= attached]
+            if ready:
+                destGroups = listGroups(NSX, logger, args)
+        except requestErrors + (KeyError,) as e:
+            logger.log("WARN - polling %s failed, retrying in %d seconds: %s"
+                       %(args.nsx, args.watchInterval, e), verbose=True)
+            ready = []
+        if ready and 'results' not in destGroups:
+            logger.log("WARN - listing groups on %s failed, retrying in %d seconds"
+                       %(args.nsx, args.watchInterval), verbose=True)
+            ready = []
+        if ready:
+            wave+=1
+            logger.log("Wave %d: %d groups have all their VMs attached, %d groups waiting"
+                       %(wave, len(ready), len(waiting)-len(ready)), verbose=True)
+            for gm in ready:
+                del waiting[gm['newUrl']]
+            processGroups(NSX, {'groups': ready}, migratedGroups, logger, args, destGroups)
+            submitGroups(NSX, {'groups': ready}, logger, args)
+            writeJson(groupMaps, args.postData, indent=4)
+            if stateDb:
+                stateDb.savePostMigrate(ready)
+        if not waiting:
+            break
+        if deadline and time.time() + args.watchInterval > deadline:
+            logger.log("Watch timeout reached with %d groups still waiting for VM attachment"
+                       %len(waiting), verbose=True)
+            break
+        time.sleep(args.watchInterval)
+    return waiting
+
 def main():
     args = parseParameters()
     site="default"
@@ -184,14 +431,27 @@ def main():
                                  site=site,
                                  enforcement=enforcementPoint,
                                  domain=domain,
-                                 timeout=None)
+                                 timeout=(args.connectTimeout, args.readTimeout),
+                                 limiter=connections.RateLimiter(rate=args.nsxRate,
+                                                                 concurrency=args.nsxConcurrency))
 
     NSX = NSXT(mp=nsx, logger=logger, site=site, enforcementPoint=enforcementPoint)
     logger.log("Connected to %s with user %s" % (args.nsx, args.nsxUser), verbose=True)
 
-    logger.log("Retrieving group configs from %s" %args.migrationData, verbose=True)
-    with open(args.migrationData, "r") as fp:
-        groupMaps = json.load(fp)
+    stateDb = None
+    if args.stateDb:
+        logger.log("Retrieving group configs from %s" %args.stateDb, verbose=True)
+        stateDb = StateDb(args.stateDb, logger)
+        groupMaps = {'groups': stateDb.groups(args.groups)}
+        if args.watch:
+            vms, moIds = groupVms(groupMaps['groups'])
+            groupMaps['ports'] = stateDb.vms(vms, moIds)
+    else:
+        logger.log("Retrieving group configs from %s" %args.migrationData, verbose=True)
+        groupMaps = readJson(args.migrationData)
+        if args.groups:
+            groupMaps['groups'] = [gm for gm in groupMaps['groups']
+                                   if gm['url'] in args.groups or gm['newUrl'] in args.groups]
 
     logger.log("Number of groups found in newGroups.json: %d"
                %len(groupMaps['groups']), verbose=True)
@@ -203,15 +463,21 @@ def main():
         logger.log("Processing %d groups on NSX Manger %s that were migrated with prefix %s"
                    %(migratedGroups['result_count'], args.nsx, args.prefix), verbose=True)
 
+    if args.watch:
+        logger.log("Watching VM attachments to clean up groups as their VMs are migrated",
+                   verbose=True)
+        watchGroups(NSX, groupMaps, migratedGroups['results'], logger, args, stateDb)
+        return
+
     processGroups(NSX, groupMaps,
                   migratedGroups['results'],
                   logger, args)
 
     logger.log("Submitting changes to NSX: %s" %args.nsx, verbose=True)
     submitGroups(NSX, groupMaps, logger, args)
-    slogger=Logger(file=args.postData, mode="w", verbose=False)
-    slogger.log(groupMaps, jsonData=True, jheader=False, verbose=False)
-    slogger.close()
+    writeJson(groupMaps, args.postData, indent=4)
+    if stateDb:
+        stateDb.savePostMigrate(groupMaps['groups'])
     
     
 if __name__=="__main__":
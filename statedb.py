@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+import json
+import sqlite3
+import threading
+
+class StateDb(object):
+    '''
+    SQLite store of the objects migrated by migrator.py and the results of
+    their submission, so that postmigrate.py and audits can query just the
+    objects they need instead of loading the whole migration data file.
+        entities - one row per migrated object with its type, MC (old) path,
+                   destination (new) path, status, submitted body and result
+        groups   - the group mappings, with the post migration cleanup data
+                   recorded by postmigrate.py
+        vms      - the segment ports pre-created for each VM
+    Status is one of successful, failed, notSubmitted or matched for services
+    and context profiles found on the destination.  Ports have the VM
+    instance UUID and vNIC index, e.g. <uuid>:4000, as old path.
+    '''
+    schema = [
+        "CREATE TABLE IF NOT EXISTS entities (ref TEXT PRIMARY KEY, type TEXT, method TEXT,"
+        " old_path TEXT, new_path TEXT, group_id INTEGER, status TEXT, body TEXT, result TEXT)",
+        "CREATE INDEX IF NOT EXISTS entities_old_path ON entities (old_path)",
+        "CREATE INDEX IF NOT EXISTS entities_new_path ON entities (new_path)",
+        "CREATE INDEX IF NOT EXISTS entities_type ON entities (type, status)",
+        "CREATE INDEX IF NOT EXISTS entities_status ON entities (status)",
+        "CREATE INDEX IF NOT EXISTS entities_group_id ON entities (group_id)",
+        "CREATE TABLE IF NOT EXISTS groups (id INTEGER PRIMARY KEY, old_path TEXT,"
+        " new_path TEXT, data TEXT, post_migrate TEXT)",
+        "CREATE INDEX IF NOT EXISTS groups_old_path ON groups (old_path)",
+        "CREATE INDEX IF NOT EXISTS groups_new_path ON groups (new_path)",
+        "CREATE TABLE IF NOT EXISTS vms (vm TEXT PRIMARY KEY, mo_id TEXT, data TEXT)",
+        "CREATE INDEX IF NOT EXISTS vms_mo_id ON vms (mo_id)"
+    ]
+
+    # stay under the SQLite limit of host parameters per statement
+    chunkSize = 500
+
+    def __init__(self, filename, logger):
+        self.filename = filename
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        # let audit queries read while migrator.py writes
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            for statement in self.schema:
+                self.db.execute(statement)
+
+    def __encode(self, data):
+        if data is None:
+            return None
+        return json.dumps(data, separators=(',', ':'))
+
+    def save(self, entities, groups, vms):
+        '''
+        Replace the content of the store.
+        entities - list of dicts with ref, type, method, oldPath, newPath,
+                   groupId, status, body and result
+        groups - list of (id, old path, new path, group mapping)
+        vms - list of (VM instance UUID, moId, ports)
+        '''
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM entities")
+            self.db.execute("DELETE FROM groups")
+            self.db.execute("DELETE FROM vms")
+            self.db.executemany("INSERT INTO entities VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                [(self.__encode(e['ref']), e['type'], e['method'],
+                                  e['oldPath'], e['newPath'], e['groupId'], e['status'],
+                                  self.__encode(e['body']), self.__encode(e['result']))
+                                 for e in entities])
+            self.db.executemany("INSERT INTO groups VALUES (?, ?, ?, ?, NULL)",
+                                [(i, old, new, self.__encode(gm)) for i, old, new, gm in groups])
+            self.db.executemany("INSERT INTO vms VALUES (?, ?, ?)",
+                                [(vm, moId, self.__encode(ports)) for vm, moId, ports in vms])
+        self.logger.log("Saved %d objects, %d groups and %d VMs to state store %s"
+                        %(len(entities), len(groups), len(vms), self.filename))
+
+    def saveResults(self, results):
+        '''
+        Update the status and result of entities, results is a list of
+        (ref, status, result)
+        '''
+        with self.lock, self.db:
+            self.db.executemany("UPDATE entities SET status=?, result=? WHERE ref=?",
+                                [(status, self.__encode(result), self.__encode(ref))
+                                 for ref, status, result in results])
+
+    def savePostMigrate(self, groups):
+        '''
+        Record the post migration data of group mappings
+        '''
+        with self.lock, self.db:
+            self.db.executemany("UPDATE groups SET post_migrate=? WHERE new_path=?",
+                                [(self.__encode(gm.get('postMigrate')), gm['newUrl'])
+                                 for gm in groups])
+
+    def __select(self, query, column, values):
+        rows = []
+        values = list(values)
+        for i in range(0, len(values), self.chunkSize):
+            chunk = values[i:i+self.chunkSize]
+            rows.extend(self.db.execute(query % (column, ",".join("?" * len(chunk))),
+                                        chunk).fetchall())
+        return rows
+
+    def groups(self, paths=None):
+        '''
+        Return the group mappings, or only those with an old or new path
+        in paths
+        '''
+        with self.lock:
+            if paths is None:
+                rows = self.db.execute("SELECT id, data FROM groups").fetchall()
+            else:
+                query = "SELECT id, data FROM groups WHERE %s IN (%s)"
+                rows = set(self.__select(query, "old_path", paths)
+                           + self.__select(query, "new_path", paths))
+        return [json.loads(data) for i, data in sorted(rows)]
+
+    def vms(self, vms, moIds=[]):
+        '''
+        Return the ports of the VMs with an instance UUID in vms or a moId
+        in moIds, in the format of the migration data ports
+        '''
+        with self.lock:
+            query = "SELECT vm, data FROM vms WHERE %s IN (%s)"
+            rows = self.__select(query, "vm", vms) + self.__select(query, "mo_id", moIds)
+        return {vm: json.loads(data) for vm, data in rows}
+
+    def close(self):
+        with self.lock:
+            self.db.close()